@@ -0,0 +1,18 @@
+# writes the parquet cache of a cohort extract (output/input_<cohort>.csv.gz -> output/input_<cohort>.parquet)
+# and, with "npy", its numpy column store too (output/input_<cohort>_npy/)
+# usage: python analysis/extract_cache.py <cohort> [npy]
+# no action runs this yet, since only the R scripts read the extracts; to use the cache in the pipeline,
+# add an action running it (with needs: [extract_<cohort>]) and add that action to the needs of each python action
+# that calls readextract, as an action only sees the outputs of the actions it needs
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from extract_functions import writeextractcache, writeextractstore
+
+cohort = sys.argv[1]
+writeextractcache(cohort)
+
+if "npy" in sys.argv[2:]:
+    writeextractstore(cohort)
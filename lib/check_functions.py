@@ -0,0 +1,386 @@
+# checks the vectorised survival and counting-process functions in lib/functions.py and lib/interval_functions.py
+# against direct, row-by-row implementations of the same estimators on small random cohorts,
+# and times KMestimate and KMestimategroup on cohorts of 1e5 rows upwards
+# usage: python lib/check_functions.py [benchmark [maxrows]]
+# (benchmark maxrows defaults to 1e7; 1e8 rows of int16 times needs about 4GB of memory)
+
+import os
+import sys
+import time as timer
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from functions import (
+    KMestimate, KMestimategroup, KMaccumulator, CIFestimate, CIFestimategroup, MCFestimate, logrank, RMSTestimate
+)
+from interval_functions import tmerge, persontime, periodsplit, timesincecut
+
+
+## row-by-row reference implementations
+
+
+def bruteKM(time, indicator, weights=None, entry=None):
+    # kaplan meier by a loop over distinct times, with (weighted) risk sets counted directly
+    # with entry times, a record is at risk at t if entry < t <= time, and a missing entry time means no delayed entry
+    # returns the columns of KMestimate, plus the infinitesimal jackknife variance of log(kmestimate) (as for weighted fits)
+    time = np.asarray(time, dtype=np.float64)
+    indicator = np.asarray(indicator)
+    weights = np.ones(time.size) if weights is None else np.asarray(weights, dtype=np.float64)
+    entry = np.full(time.size, -np.inf) if entry is None else np.nan_to_num(np.asarray(entry, dtype=np.float64), nan=-np.inf)
+    keep = (weights != 0) & (time > entry)
+    time, indicator, weights, entry = time[keep], indicator[keep], weights[keep], entry[keep]
+
+    rows = []
+    surv = 1.0
+    influence = np.zeros(time.size)
+    for t in np.unique(time):
+        atrisk_i = (entry < t) & (time >= t)
+        event_i = (time == t) & (indicator == 1)
+        atrisk = weights[atrisk_i].sum()
+        n_events = weights[event_i].sum()
+        censored = weights[(time == t) & (indicator == 0)].sum()
+        surv *= max(1 - n_events/atrisk, 0)
+        # each record's influence on log(kmestimate): -(dN_i - Y_i * n_events / atrisk) / atrisk
+        influence -= (event_i - atrisk_i * n_events/atrisk) / atrisk
+        rows.append((t, atrisk, n_events, censored, surv, (weights**2 * influence**2).sum()))
+
+    return pd.DataFrame(rows, columns=['time', 'atrisk', 'n_events', 'censored', 'kmestimate', 'var_logkm'])
+
+
+def bruteCIF(time, eventtype):
+    # aalen-johansen cumulative incidence of each cause by a loop over distinct times
+    time = np.asarray(time, dtype=np.float64)
+    eventtype = np.asarray(eventtype)
+    causes = sorted(set(eventtype[eventtype > 0]))
+    surv = 1.0
+    cmlinc = dict.fromkeys(causes, 0.0)
+    rows = []
+    for t in np.unique(time):
+        atrisk = (time >= t).sum()
+        for cause in causes:
+            cmlinc[cause] += surv * ((time == t) & (eventtype == cause)).sum() / atrisk
+        surv *= 1 - ((time == t) & (eventtype > 0)).sum() / atrisk
+        rows.append([t, surv] + [cmlinc[cause] for cause in causes])
+    return pd.DataFrame(rows, columns=['time', 'kmestimate'] + [f"cmlinc_{cause}" for cause in causes])
+
+
+def brutelogrank(time, indicator, isgroup1):
+    # observed and expected events in group 1, and the variance, by a loop over event times
+    observed = expected = variance = 0.0
+    for t in np.unique(time[indicator == 1]):
+        atrisk = (time >= t).sum()
+        atrisk1 = ((time >= t) & isgroup1).sum()
+        n_events = ((time == t) & (indicator == 1)).sum()
+        observed += ((time == t) & (indicator == 1) & isgroup1).sum()
+        expected += n_events * atrisk1/atrisk
+        if atrisk > 1:
+            variance += n_events * (atrisk1/atrisk) * (1 - atrisk1/atrisk) * (atrisk - n_events)/(atrisk - 1)
+    return observed, expected, variance
+
+
+def bruteRMST(kmdata, horizon):
+    # area under the km step function from 0 to horizon, and its greenwood-type standard error, interval by interval
+    times = np.concatenate(([0.0], kmdata['time'].to_numpy(dtype=np.float64)))
+    surv = np.concatenate(([1.0], kmdata['kmestimate'].to_numpy()))
+    ends = np.append(times[1:], np.inf)
+    areas = [s * max(min(end, horizon) - max(t, 0), 0) for t, end, s in zip(times, ends, surv)]
+    rmst = sum(areas)
+    variance = 0.0
+    for j, row in enumerate(kmdata.itertuples()):
+        if row.time <= horizon and 0 < row.n_events < row.atrisk:
+            area_after = sum(areas[j+1:])
+            variance += area_after**2 * row.n_events / (row.atrisk * (row.atrisk - row.n_events))
+    return rmst, np.sqrt(variance)
+
+
+def bruteMCF(origin, eventdays, censor):
+    # nelson-aalen mean cumulative function and lawless-nadeau standard error on days 0 to max(censor - origin)
+    follow = censor - origin
+    days = np.arange(follow.max() + 1)
+    atrisk = follow[:, None] >= days
+    dN = np.zeros((follow.size, days.size))
+    for i in range(follow.size):
+        for event in eventdays[i]:
+            if not np.isnan(event) and 0 <= event - origin[i] <= follow[i]:
+                dN[i, int(event - origin[i])] += 1
+    Y = atrisk.sum(axis=0)
+    dmcf = np.where(Y > 0, dN.sum(axis=0) / np.maximum(Y, 1), 0)
+    terms = np.where(atrisk, (dN - dmcf) / np.maximum(Y, 1), 0)
+    return Y, np.cumsum(dmcf), np.sqrt((np.cumsum(terms, axis=1)**2).sum(axis=0))
+
+
+def brutetmerge(df, tstop, tdcs, events):
+    # counting-process intervals from 0 to tstop, patient by patient
+    rows = []
+    for patient in df.itertuples(index=False):
+        row = patient._asdict()
+        times = [row[col] for col in list(tdcs.values()) + list(events.values())]
+        cuts = sorted({t for t in times if t == t and 0 < t < row[tstop]})
+        bounds = [0] + cuts + [row[tstop]]
+        for lower, upper in zip(bounds[:-1], bounds[1:]):
+            interval = {**row, 'tstart': lower, 'tstop': upper}
+            interval.update({name: int(row[col] <= lower) for name, col in tdcs.items()})
+            interval.update({name: int(row[col] == upper) for name, col in events.items()})
+            rows.append(interval)
+    return pd.DataFrame(rows)
+
+
+## checks
+
+
+KMCOLUMNS = ['time', 'atrisk', 'n_events', 'censored', 'kmestimate']
+
+
+def assertclose(result, reference, columns):
+    for col in columns:
+        assert np.allclose(result[col].to_numpy(dtype=np.float64), reference[col].to_numpy(dtype=np.float64), equal_nan=True), col
+
+
+def checkKM(rng, n=2000):
+    # integer day times (counted with bincount) and float times (sorted)
+    time = rng.integers(0, 80, n)
+    indicator = rng.integers(0, 2, n)
+    reference = bruteKM(time, indicator)
+    assertclose(KMestimate(time, indicator), reference, KMCOLUMNS)
+    assertclose(KMestimate(time + 0.5, indicator).assign(time=lambda d: d.time - 0.5), reference, KMCOLUMNS)
+
+
+def checkKMgroup(rng, n=2000):
+    # every group fitted at once, from binned (integer) and sorted (float) times, matching each group fitted alone
+    df = pd.DataFrame({'time': rng.integers(0, 80, n), 'indicator': rng.integers(0, 2, n), 'group': rng.choice(['a', 'b', 'c', None], n)})
+    for offset in [0, 0.5]:
+        grouped = KMestimategroup(df.assign(time=df.time + offset), 'time', 'indicator', 'group')
+        assert grouped.group.tolist() == sorted(grouped.group, key=df.group.dropna().unique().tolist().index)
+        for group, sub in df.groupby('group'):
+            result = grouped[grouped.group == group].assign(time=lambda d: d.time - offset)
+            assertclose(result, bruteKM(sub.time, sub.indicator), KMCOLUMNS)
+
+
+def checkKMaccumulator(rng, n=2000):
+    # chunks accumulated separately (including empty chunks and accumulators) and merged, keeping integer times
+    time = rng.integers(0, 80, n)
+    indicator = rng.integers(0, 2, n)
+    accumulators = [KMaccumulator().merge(KMaccumulator()) for _ in range(3)]
+    for k, chunk in enumerate(np.array_split(np.arange(n), 7)):
+        accumulators[k % 3].update(time[chunk], indicator[chunk]).update(time[:0], indicator[:0])
+    accumulator = KMaccumulator().merge(accumulators[0]).merge(KMaccumulator()).merge(accumulators[1]).merge(accumulators[2])
+    kmdata = accumulator.finalize()
+    assert kmdata.time.dtype == time.dtype
+    assertclose(kmdata, bruteKM(time, indicator), KMCOLUMNS)
+
+
+def checkKMweights(rng, n=2000):
+    # case-sampling weights (a third of non-events sampled, with weight 3), alone and by group,
+    # including a last time where everyone left has the event, so the last factor is a rounding error from zero
+    time = rng.integers(0, 80, n)
+    indicator = rng.integers(0, 2, n)
+    indicator[time == time.max()] = 1
+    weights = np.where(indicator == 1, 1.0, rng.choice([0, 3.0], n))
+    kmdata = KMestimate(time, indicator, weights)
+    assertclose(kmdata, bruteKM(time, indicator, weights), KMCOLUMNS + ['var_logkm'])
+    assert (kmdata.kmestimate >= 0).all()
+
+    df = pd.DataFrame({'time': time, 'indicator': indicator, 'weights': weights, 'group': rng.choice(['a', 'b', 'c'], n)})
+    grouped = KMestimategroup(df, 'time', 'indicator', 'group', weights='weights')
+    for group, sub in df.groupby('group'):
+        assertclose(grouped[grouped.group == group], bruteKM(sub.time, sub.indicator, sub.weights), KMCOLUMNS + ['var_logkm'])
+
+
+def checkCIF(rng, n=2000):
+    # competing risks, alone and by group
+    time = rng.integers(0, 60, n)
+    eventtype = rng.choice([0, 1, 2], n, p=[0.7, 0.1, 0.2])
+    columns = ['time', 'kmestimate', 'cmlinc_1', 'cmlinc_2']
+    assertclose(CIFestimate(time, eventtype), bruteCIF(time, eventtype), columns)
+
+    df = pd.DataFrame({'time': time + 0.5, 'eventtype': eventtype, 'group': rng.choice(['x', 'y'], n)})
+    grouped = CIFestimategroup(df, 'time', 'eventtype', 'group')
+    for group, sub in df.groupby('group'):
+        assertclose(grouped[grouped.group == group], bruteCIF(sub.time, sub.eventtype), columns)
+
+
+def checkKMentry(rng, n=2000):
+    # delayed entry, some of it missing (no delayed entry), with and without weights, alone and by group
+    time = rng.integers(0, 80, n)
+    indicator = rng.integers(0, 2, n)
+    weights = np.where(indicator == 1, 1.0, rng.choice([0, 3.0], n))
+    entry = np.where(rng.random(n) < 0.1, np.nan, rng.integers(-5, 40, n))
+    assertclose(KMestimate(time, indicator, entry=entry), bruteKM(time, indicator, entry=entry), KMCOLUMNS)
+    assertclose(KMestimate(time, indicator, weights, entry), bruteKM(time, indicator, weights, entry), KMCOLUMNS + ['var_logkm'])
+
+    df = pd.DataFrame({'time': time, 'indicator': indicator, 'weights': weights, 'entry': entry, 'group': rng.choice(['a', 'b', 'c'], n)})
+    grouped = KMestimategroup(df, 'time', 'indicator', 'group', entry='entry')
+    weighted = KMestimategroup(df, 'time', 'indicator', 'group', weights='weights', entry='entry')
+    for group, sub in df.groupby('group'):
+        assertclose(grouped[grouped.group == group], bruteKM(sub.time, sub.indicator, entry=sub.entry), KMCOLUMNS)
+        reference = bruteKM(sub.time, sub.indicator, sub.weights, sub.entry)
+        assertclose(weighted[weighted.group == group], reference, KMCOLUMNS + ['var_logkm'])
+
+
+def cohort(rng, n=1000):
+    # one row per patient with integer end of follow-up and tte_ times (some missing), for the interval checks
+    def times(p):
+        x = rng.integers(-3, 115, n).astype(np.float64)
+        x[rng.random(n) < p] = np.nan
+        return x
+
+    return pd.DataFrame({
+        'patient_id': np.arange(n) + 100, 'tte_end': rng.integers(1, 112, n),
+        'tte_vax1': times(0.3), 'tte_vax2': times(0.6), 'tte_event': times(0.8),
+        'sex': rng.choice(['F', 'M'], n),
+    })
+
+
+def checktmerge(rng, n=1000):
+    # tmerge in chunks, with the patient columns carried onto every interval
+    # whole-day cuts keep integer tstart and tstop, and a cut part-way through a day does not get truncated
+    df = cohort(rng, n)
+    tdcs = {'vax1_status': 'tte_vax1', 'vax2_status': 'tte_vax2'}
+    events = {'event': 'tte_event'}
+    cpdata = tmerge(df, 'patient_id', 0, 'tte_end', tdcs=tdcs, events=events, chunksize=300)
+    reference = brutetmerge(df, 'tte_end', tdcs, events)[cpdata.columns]
+    pd.testing.assert_frame_equal(cpdata, reference, check_dtype=False)
+    assert pd.api.types.is_integer_dtype(cpdata.tstop)
+
+    df.loc[df.index[:50], 'tte_vax1'] += 0.5
+    cpdata = tmerge(df, 'patient_id', 0, 'tte_end', tdcs=tdcs, events=events, chunksize=300)
+    reference = brutetmerge(df, 'tte_end', tdcs, events)[cpdata.columns]
+    pd.testing.assert_frame_equal(cpdata, reference, check_dtype=False)
+
+
+def checkpersontime(rng, n=1000):
+    # person-days and events per (stratum, day), against one row per patient per day
+    tdcs = {'vax1_status': 'tte_vax1'}
+    cpdata = tmerge(cohort(rng, n), 'patient_id', 0, 'tte_end', tdcs=tdcs, events={'event': 'tte_event'})
+    ptdata = persontime(cpdata, 'tstart', 'tstop', strata=['vax1_status', 'sex'], events=['event'])
+    rows = np.repeat(np.arange(len(cpdata)), cpdata.tstop - cpdata.tstart)
+    day = np.concatenate([np.arange(lower + 1, upper + 1) for lower, upper in zip(cpdata.tstart, cpdata.tstop)])
+    daily = pd.DataFrame({
+        'vax1_status': cpdata.vax1_status.to_numpy()[rows], 'sex': cpdata.sex.to_numpy()[rows], 'day': day,
+        'event': (cpdata.event.to_numpy()[rows] == 1) & (cpdata.tstop.to_numpy()[rows] == day),
+    })
+    reference = daily.groupby(['vax1_status', 'sex', 'day']).agg(persondays=('event', 'size'), event=('event', 'sum')).reset_index()
+    merged = ptdata.merge(reference, on=['vax1_status', 'sex', 'day'], how='outer', suffixes=('', '_ref')).fillna(0)
+    assert (merged.persondays == merged.persondays_ref).all() and (merged.event == merged.event_ref).all()
+
+
+def checkperiodsplit(rng, n=1000):
+    # time since vaccination periods, against the period of each day, as in timesince2_cut
+    # and the same split built in chunks of rows
+    tdcs = {'vax1_status': 'tte_vax1', 'vax2_status': 'tte_vax2'}
+    cpdata = tmerge(cohort(rng, n), 'patient_id', 0, 'tte_end', tdcs=tdcs, events={'event': 'tte_event'})
+    breaks = [0, 3, 7, 14, 21]
+    split = periodsplit(cpdata, 'tstart', 'tstop', ['tte_vax1', 'tte_vax2'], breaks, events=['event'])
+    rows = np.repeat(np.arange(len(split)), split.tstop - split.tstart)
+    day = np.concatenate([np.arange(lower + 1, upper + 1) for lower, upper in zip(split.tstart, split.tstop)])
+    since1 = day - split.tte_vax1.to_numpy()[rows]
+    since2 = day - split.tte_vax2.to_numpy()[rows]
+    period = np.where(
+        since2 > 0, np.asarray(timesincecut(since2, breaks, prefix='Dose 2 ')),
+        np.where(since1 > 0, np.asarray(timesincecut(since1, breaks, prefix='Dose 1 ')), 'pre')
+    )
+    assert (period == np.asarray(split.period)[rows]).all()
+    assert split.event.sum() == cpdata.event.sum()
+
+    chunked = periodsplit(cpdata, 'tstart', 'tstop', ['tte_vax1', 'tte_vax2'], breaks, events=['event'], chunksize=400)
+    pd.testing.assert_frame_equal(chunked, split)
+
+
+def checkMCF(rng, n=300):
+    # recurrent events (some before origin or after censoring) by group, with dates as datetimes
+    origin = rng.integers(0, 20, n)
+    censor = origin + rng.integers(0, 60, n)
+    eventdays = np.where(rng.random((n, 4)) < 0.5, origin[:, None] + rng.integers(-5, 70, (n, 4)), np.nan)
+    start = pd.Timestamp('2020-12-07')
+    todate = lambda days: start + pd.to_timedelta(days, 'D')
+    df = pd.DataFrame({'origin': todate(origin), 'censor': todate(censor), 'group': rng.choice(['a', 'b'], n)})
+    events = [f"event{k}" for k in range(4)]
+    for k, col in enumerate(events):
+        df[col] = todate(eventdays[:, k])
+
+    mcfdata = MCFestimate(df, 'origin', events, 'censor', group='group')
+    for group, rows in df.groupby('group').indices.items():
+        atrisk, mcf, se_mcf = bruteMCF(origin[rows], eventdays[rows], censor[rows])
+        result = mcfdata[mcfdata.group == group].iloc[:atrisk.size]
+        assert (result.atrisk.to_numpy() == atrisk).all()
+        assert np.allclose(result.mcf, mcf) and np.allclose(result.se_mcf, se_mcf)
+
+
+def checklogrankRMST(rng, n=1500):
+    # pairwise and stratified log-rank tests, and restricted mean survival times, from KMestimategroup output
+    df = pd.DataFrame({
+        'time': rng.integers(1, 60, n).astype(np.float64),
+        'indicator': rng.integers(0, 2, n),
+        'group': rng.choice(['u', 'v', 'w'], n),
+        'stratum': rng.choice(['f', 'm'], n),
+    })
+    df.loc[df.group == 'v', 'time'] += rng.integers(0, 10, (df.group == 'v').sum())
+
+    kmdata = KMestimategroup(df, 'time', 'indicator', 'group')
+    for row in logrank(kmdata, 'group').itertuples():
+        pair = df[df.group.isin([row.group_1, row.group_2])]
+        reference = brutelogrank(pair.time.to_numpy(), pair.indicator.to_numpy(), (pair.group == row.group_1).to_numpy())
+        assert np.allclose([row.observed_1, row.expected_1, row.variance], reference)
+
+    stratified = logrank(KMestimategroup(df, 'time', 'indicator', ['stratum', 'group']), 'group', strata='stratum')
+    for row in stratified.itertuples():
+        pair = df[df.group.isin([row.group_1, row.group_2])]
+        reference = np.sum([
+            brutelogrank(sub.time.to_numpy(), sub.indicator.to_numpy(), (sub.group == row.group_1).to_numpy())
+            for _, sub in pair.groupby('stratum')
+        ], axis=0)
+        assert np.allclose([row.observed_1, row.expected_1, row.variance], reference)
+
+    rmstdata = RMSTestimate(kmdata, [20, 45.5], group='group')
+    for row in rmstdata.itertuples():
+        reference = bruteRMST(kmdata[kmdata.group == row.group], row.horizon)
+        assert np.allclose([row.rmst, row.se_rmst], reference)
+
+
+# every check, run in order by runchecks
+CHECKS = [
+    checkKM, checkKMgroup, checkKMaccumulator, checkKMweights, checkCIF, checkKMentry,
+    checktmerge, checkpersontime, checkperiodsplit, checkMCF, checklogrankRMST,
+]
+
+
+def runchecks():
+    rng = np.random.default_rng(2021)
+    for check in CHECKS:
+        start = timer.perf_counter()
+        check(rng)
+        print(f"{check.__name__}: ok ({timer.perf_counter() - start:.1f}s)")
+
+
+## benchmark
+
+
+def runbenchmark(maxrows=10**7):
+    # follow-up days 0-111 as int16 with 10% events, as for the over80s cohort
+    rng = np.random.default_rng(1)
+    print(f"{'rows':>12} {'KMestimate':>12} {'KMestimategroup (100 groups)':>30}")
+    n = 10**5
+    while n <= maxrows:
+        df = pd.DataFrame({
+            'time': rng.integers(0, 112, n, dtype=np.int16),
+            'indicator': (rng.random(n) < 0.1).astype(np.int8),
+            'group': rng.integers(0, 100, n, dtype=np.int8),
+        })
+        start = timer.perf_counter()
+        KMestimate(df.time, df.indicator)
+        single = timer.perf_counter() - start
+        start = timer.perf_counter()
+        KMestimategroup(df, 'time', 'indicator', 'group')
+        grouped = timer.perf_counter() - start
+        print(f"{n:>12,} {single:>11.3f}s {grouped:>29.3f}s")
+        del df
+        n *= 10
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['benchmark']:
+        runbenchmark(int(float(sys.argv[2])) if len(sys.argv) > 2 else 10**7)
+    else:
+        runchecks()
@@ -0,0 +1,573 @@
+import ast
+import json
+import os
+import shutil
+import pandas as pd
+import numpy as np
+
+from functions import extractpath, studystartdate, _todays, _encodedays
+
+# pyarrow is only needed for the parquet cache of each extract
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+## typed loading of cohortextractor extracts (output/input_<cohort>.csv.gz)
+## each column's type is read from the StudyDefinition in analysis/study_definition_<cohort>.py,
+## by parsing the file rather than running it, so cohortextractor does not need to be installed
+## dates are read as day offsets from the study start_date (see encodeseries in functions.py),
+## flags as uint8, categories as pandas categoricals, and numbers as nullable Int32 or float32
+
+
+# patients functions that return a category, integer or float whatever returning= is
+_CATEGORYFUNCTIONS = {'sex', 'categorised_as', 'care_home_status_as_of', 'with_ethnicity_from_sus'}
+_INTFUNCTIONS = {'age_as_of'}
+_FLOATFUNCTIONS = {'most_recent_bmi'}
+
+# returning= values that are not dates or binary flags
+_CATEGORYRETURNING = {'category', 'code', 'msoa', 'stp_code', 'nuts1_region_name', 'group_6', 'group_16'}
+_INTRETURNING = {
+    'pseudo_id', 'index_of_multiple_deprivation', 'rural_urban_classification',
+    'number_of_matches_in_period', 'number_of_episodes', 'percentage_of_members_with_data_in_this_backend',
+}
+_FLOATRETURNING = {'numeric_value', 'float_value'}
+
+# read_csv dtypes of each kind of column
+# dates are read as categoricals of strings, so each distinct date is parsed once per chunk (by _parseymd) and then encoded
+_KINDDTYPES = {'flag': np.uint8, 'int': 'Int32', 'float': np.float32, 'category': 'category', 'date': 'category'}
+
+
+def studydefinitionpath(cohort):
+    # path of the study definition for cohort (eg "over80s"), analysis/study_definition_<cohort>.py
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analysis', f"study_definition_{cohort}.py")
+
+
+def _variablekind(call):
+    # kind of column ('date', 'flag', 'int', 'float' or 'category') returned by a patients.<function>(...) call
+
+    function = call.func.attr
+    kwargs = {kw.arg: kw.value for kw in call.keywords}
+    returning = kwargs['returning'].value if isinstance(kwargs.get('returning'), ast.Constant) else None
+
+    if 'date_format' in kwargs or (returning or '').startswith('date') or function.startswith('date'):
+        return 'date'
+    if function in _CATEGORYFUNCTIONS or returning in _CATEGORYRETURNING or 'categorised_as' in kwargs:
+        return 'category'
+    if function in _INTFUNCTIONS or returning in _INTRETURNING:
+        return 'int'
+    if function in _FLOATFUNCTIONS or returning in _FLOATRETURNING:
+        return 'float'
+    # binary_flag is the default for every other patients function (satisfying, with_these_clinical_events, ...)
+    return 'flag'
+
+
+def extractschema(cohort):
+    # takes a cohort name (eg "over80s") and returns a dict of column name: kind of column
+    # for the extract made from its study definition, in study definition order
+    # only the StudyDefinition's own variables are output by cohortextractor,
+    # so variables defined inside patients.satisfying or patients.categorised_as are not included
+
+    with open(studydefinitionpath(cohort)) as f:
+        tree = ast.parse(f.read())
+
+    calls = [
+        node for node in ast.walk(tree)
+        if isinstance(node, ast.Call) and getattr(node.func, 'id', None) == 'StudyDefinition'
+    ]
+    if len(calls) != 1:
+        raise ValueError(f"expected one StudyDefinition in {studydefinitionpath(cohort)}, found {len(calls)}")
+
+    schema = {'patient_id': 'int'}
+    for kw in calls[0].keywords:
+        if kw.arg == 'population' or not isinstance(kw.value, ast.Call) or not isinstance(kw.value.func, ast.Attribute):
+            continue
+        if getattr(kw.value.func.value, 'id', None) == 'patients':
+            schema[kw.arg] = _variablekind(kw.value)
+
+    return schema
+
+
+def readextract(cohort, columns=None, filters=None, chunksize=20000, path=None, usecache=True):
+    # reads the extract for cohort (output/input_<cohort>.csv.gz, unless path is given) with compact types from extractschema:
+    # dates as int16 (or int32) day offsets, flags as uint8, categories as categoricals, and numbers as Int32 or float32
+    # columns not in the study definition are left to read_csv
+    # columns is an optional list of columns to read
+    # filters is an optional list of (column, op, value) conditions that rows must all meet, as in pyarrow,
+    # eg [('region', '=', 'London'), ('age', '>=', 80)], with op one of =, ==, !=, <, <=, >, >=, in, not in
+    # (dates are compared as encoded day offsets, so a missing date is less than any other)
+    #
+    # if the extract's parquet cache (from writeextractcache) is newer than the csv, and pyarrow is installed,
+    # it is read instead (with the same rows, in the same order), unless usecache is False
+    #
+    # the file is read chunksize rows at a time, and each chunk is converted and copied into one growing array per column
+    # before the next is read, so peak memory is the compact data plus the uncompact strings of one chunk
+    # (which, with ~70 date columns, is a few kilobytes per row, hence the small default chunksize)
+
+    if path is None and usecache and pq is not None and _iscachefresh(cohort):
+        return readextractcache(cohort, columns, filters)
+
+    schema = extractschema(cohort)
+    path = extractpath(cohort) if path is None else path
+    filters = list(filters or [])
+
+    header = pd.read_csv(path, nrows=0).columns
+    outcols = [col for col in header if columns is None or col in columns]
+    usecols = [col for col in header if col in outcols or any(col == f[0] for f in filters)]
+    kinds = {col: schema.get(col) for col in usecols}
+    dtypes = {col: _KINDDTYPES[kind] for col, kind in kinds.items() if kind is not None}
+    dates = [col for col in usecols if kinds[col] == 'date']
+    kinds = {col: kinds[col] for col in outcols}
+
+    # one buffer per column (two for Int32, values and missing mask), filled to row n
+    buffers = {}
+    for col, kind in kinds.items():
+        if kind == 'date':
+            buffers[col] = np.empty(chunksize, dtype=np.int16)
+        elif kind == 'int':
+            buffers[col] = (np.empty(chunksize, dtype=np.int32), np.empty(chunksize, dtype=bool))
+        elif kind == 'category':
+            # codes into categories, which grow as new values are seen
+            buffers[col] = (np.empty(chunksize, dtype=np.int32), pd.Index([], dtype=object))
+        elif kind is not None:
+            buffers[col] = np.empty(chunksize, dtype=dtypes[col])
+        else:
+            buffers[col] = []
+    n = 0
+
+    for chunk in pd.read_csv(path, usecols=usecols, dtype=dtypes, chunksize=chunksize):
+        encoded = {col: _encodedays(*_todays(chunk[col])) for col in dates}
+        if filters:
+            keep = _filtermask({col: encoded.get(col, chunk[col]) for col, _, _ in filters}, filters)
+            chunk = chunk[keep]
+            encoded = {col: days[keep] for col, days in encoded.items()}
+        for col, kind in kinds.items():
+            if kind == 'date':
+                days = encoded[col]
+                if days.dtype != buffers[col].dtype:
+                    # a chunk did not fit in int16, so the whole column is widened
+                    dtype = np.result_type(days, buffers[col])
+                    buffers[col] = _widendays(buffers[col][:n], dtype)
+                    days = _widendays(days, dtype)
+                buffers[col] = _bufferappend(buffers[col], days, n)
+            elif kind == 'int':
+                values, mask = buffers[col]
+                buffers[col] = (
+                    _bufferappend(values, chunk[col].to_numpy(dtype=np.int32, na_value=0), n),
+                    _bufferappend(mask, chunk[col].isna().to_numpy(), n),
+                )
+            elif kind == 'category':
+                codes, categories = buffers[col]
+                values = chunk[col].array
+                categories = categories.append(values.categories.difference(categories))
+                recode = np.append(categories.get_indexer(values.categories), -1).astype(np.int32)
+                buffers[col] = (_bufferappend(codes, recode[values.codes], n), categories)
+            elif kind is not None:
+                buffers[col] = _bufferappend(buffers[col], chunk[col].to_numpy(), n)
+            else:
+                buffers[col].append(chunk[col].reset_index(drop=True))
+        n += len(chunk)
+
+    # the numpy columns of each dtype (eg every int16 date) are trimmed into the rows of one 2D block,
+    # releasing each buffer as it is copied, so the frame has one block per dtype rather than one per column
+    # (a frame of ~140 single-column blocks warns that it is highly fragmented whenever a column is added)
+    # Int32, categorical and object columns are extension or object arrays, and stay one block each
+    blockcolumns = {}
+    for col, kind in kinds.items():
+        if kind not in ('int', 'category', None):
+            blockcolumns.setdefault(buffers[col].dtype, []).append(col)
+
+    frames = []
+    for dtype, cols in blockcolumns.items():
+        block = np.empty((len(cols), n), dtype=dtype)
+        for j, col in enumerate(cols):
+            block[j] = buffers[col][:n]
+            buffers[col] = None
+        frames.append(pd.DataFrame(block.T, columns=cols, copy=False))
+
+    data = {}
+    for col, kind in kinds.items():
+        if kind == 'int':
+            values, mask = buffers[col]
+            data[col] = pd.arrays.IntegerArray(values[:n].copy(), mask[:n].copy())
+        elif kind == 'category':
+            codes, categories = buffers[col]
+            data[col] = pd.Categorical.from_codes(codes[:n], categories).reorder_categories(categories.sort_values())
+        elif kind is None:
+            data[col] = pd.concat(buffers[col], ignore_index=True) if buffers[col] else pd.Series([], dtype=object)
+        else:
+            continue
+        buffers[col] = None
+    frames.append(pd.DataFrame(data, index=pd.RangeIndex(n), copy=False))
+
+    return pd.concat(frames, axis=1)[list(kinds)]
+
+
+# pyarrow-style filter operators, applied to a column's values (a series or array) and a value
+_FILTEROPS = {
+    '=': lambda x, value: x == value,
+    '==': lambda x, value: x == value,
+    '!=': lambda x, value: x != value,
+    '<': lambda x, value: x < value,
+    '<=': lambda x, value: x <= value,
+    '>': lambda x, value: x > value,
+    '>=': lambda x, value: x >= value,
+    'in': lambda x, value: pd.Series(x).isin(value),
+    'not in': lambda x, value: ~pd.Series(x).isin(value),
+}
+
+
+def _filtermask(values, filters):
+    # boolean array of the rows of values (a dict of column: series or array) meeting every (column, op, value) in filters
+    keep = True
+    for col, op, value in filters:
+        # comparisons with missing values (eg in Int32 columns) are not met
+        keep = keep & pd.Series(_FILTEROPS[op](values[col], value)).fillna(False).to_numpy(dtype=bool)
+    return keep
+
+
+def _bufferappend(buffer, values, n):
+    # writes values into buffer from row n and returns it,
+    # or a copy with double the length (or enough for values) if buffer is too short
+    if n + len(values) > len(buffer):
+        grown = np.empty(max(2 * len(buffer), n + len(values)), dtype=buffer.dtype)
+        grown[:n] = buffer[:n]
+        buffer = grown
+    buffer[n:n + len(values)] = values
+    return buffer
+
+
+def _widendays(days, dtype):
+    # encoded day offsets as the (same or wider) integer type dtype, keeping missing days missing
+    if days.dtype == dtype:
+        return days
+    widened = days.astype(dtype)
+    widened[days == np.iinfo(days.dtype).min] = np.iinfo(dtype).min
+    return widened
+
+
+
+## parquet cache of each extract (output/input_<cohort>.parquet), written once by writeextractcache
+## with the types from readextract, rows sorted by region and stp, and one row group (or more, if large) per stp,
+## so column statistics let reads with filters on region or stp skip the other row groups
+## each row's number in the csv is stored too, and readextractcache puts rows back in csv order,
+## so readextract returns the same rows in the same order whether or not it uses the cache
+## readextract uses the cache in place of the csv whenever it is newer
+
+
+# column of the cache holding each row's number in the csv
+_CACHEROW = '_csvrow'
+
+
+def extractcachepath(cohort):
+    # path of the parquet cache of the extract for cohort, output/input_<cohort>.parquet
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'output', f"input_{cohort}.parquet")
+
+
+def _requirepyarrow():
+    if pq is None:
+        raise ImportError("the parquet cache of each extract needs pyarrow")
+
+
+def _iscachefresh(cohort):
+    # True if the parquet cache of cohort's extract exists and is at least as new as the csv
+    cachepath = extractcachepath(cohort)
+    csvpath = extractpath(cohort)
+    if not os.path.exists(cachepath):
+        return False
+    return not os.path.exists(csvpath) or os.path.getmtime(cachepath) >= os.path.getmtime(csvpath)
+
+
+def writeextractcache(cohort, path=None, partition=('region', 'stp'), row_group_size=10**6):
+    # reads the extract for cohort with readextract and writes it to extractcachepath(cohort),
+    # sorted by the partition columns, with each partition's rows in their own row group(s) of at most row_group_size rows
+    # the extract schema and study start_date are stored in the file's metadata, 
+    # since dates are stored as encoded day offsets
+    # the file is written to a temporary name and then renamed, so a partly-written cache is never read
+
+    _requirepyarrow()
+
+    data = readextract(cohort, path=path, usecache=False)
+    data[_CACHEROW] = np.arange(len(data), dtype=np.int64)
+    partition = [col for col in partition if col in data.columns]
+
+    # rows in partition order, and the first row of each partition
+    if partition:
+        codes = [pd.factorize(data[col], sort=True)[0] for col in partition]
+        order = np.lexsort(codes[::-1])
+        data = data.take(order).reset_index(drop=True)
+        codes = np.column_stack([code[order] for code in codes])
+        starts = np.flatnonzero(np.concatenate(([True], (codes[1:] != codes[:-1]).any(axis=1))))
+    else:
+        starts = np.zeros(min(len(data), 1), dtype=np.int64)
+    ends = np.append(starts[1:], len(data))
+
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    del data
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        b'extract_schema': json.dumps(extractschema(cohort)).encode(),
+        b'start_date': str(studystartdate()).encode(),
+    })
+
+    cachepath = extractcachepath(cohort)
+    temppath = cachepath + '.tmp'
+    with pq.ParquetWriter(temppath, table.schema, write_statistics=True) as writer:
+        for start, end in zip(starts, ends):
+            writer.write_table(table.slice(start, end - start), row_group_size=row_group_size)
+    os.replace(temppath, cachepath)
+
+    return cachepath
+
+
+def readextractcache(cohort, columns=None, filters=None):
+    # reads the parquet cache of the extract for cohort, as readextract would read the csv
+    # only the requested columns are decoded, and row groups that cannot meet filters are skipped using their statistics
+
+    _requirepyarrow()
+
+    cachepath = extractcachepath(cohort)
+    if _CACHEROW not in pq.read_schema(cachepath).names:
+        raise ValueError(f"{cachepath} has no csv row numbers, so needs rewriting with writeextractcache")
+    table = pq.read_table(cachepath, columns=None if columns is None else [*columns, _CACHEROW], filters=filters)
+
+    start_date = (table.schema.metadata or {}).get(b'start_date')
+    if start_date is not None and np.datetime64(start_date.decode(), 'D') != studystartdate():
+        raise ValueError(f"{cachepath} has dates encoded from a different start_date, so needs rewriting with writeextractcache")
+
+    # rows back in csv order (within each partition they already are, so the stable sort has little to do)
+    rows = table.column(_CACHEROW).to_numpy()
+    table = table.remove_column(table.schema.get_field_index(_CACHEROW))
+    table = table.take(np.argsort(rows, kind='stable'))
+
+    # converted into one block per dtype (as readextract returns), with each column's arrow memory released once converted
+    return table.to_pandas(self_destruct=True)
+
+
+
+## per-column numpy store of each extract (output/input_<cohort>_npy/<column>.npy), written once by writeextractstore
+## every column is fixed-width: int32 day offsets and integers (with the smallest int32 for missing), uint8 flags,
+## float32 numbers, and int16 category codes (-1 for missing) with each column's categories in store.json
+## readextractstore memory-maps the files, so nothing is read from disk until it is used,
+## and processes using the same store share the operating system's page cache rather than each holding a copy
+
+
+_STOREDTYPES = {'date': np.int32, 'int': np.int32, 'flag': np.uint8, 'float': np.float32, 'category': np.int16}
+
+
+def extractstorepath(cohort):
+    # path of the numpy column store of the extract for cohort, output/input_<cohort>_npy
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'output', f"input_{cohort}_npy")
+
+
+def writeextractstore(cohort, path=None):
+    # reads the extract for cohort with readextract (from its parquet cache, if fresh) 
+    # and writes each column of the study definition to its own .npy file in extractstorepath(cohort)
+    # columns not in the study definition have no fixed-width type, so are not stored
+    # the store is written to a temporary directory and then renamed, replacing any earlier store
+
+    data = readextract(cohort, path=path)
+    schema = extractschema(cohort)
+
+    storepath = extractstorepath(cohort)
+    temppath = storepath + '.tmp'
+    shutil.rmtree(temppath, ignore_errors=True)
+    os.makedirs(temppath)
+
+    kinds = {}
+    categories = {}
+    for col in data.columns:
+        kind = schema.get(col)
+        if kind == 'date':
+            values = _widendays(data[col].to_numpy(), np.int32)
+        elif kind == 'int':
+            values = data[col].to_numpy(dtype=np.int32, na_value=np.iinfo(np.int32).min)
+        elif kind == 'category':
+            if len(data[col].cat.categories) > np.iinfo(np.int16).max:
+                raise ValueError(f"{col} has too many categories for int16 codes")
+            values = data[col].cat.codes.to_numpy().astype(np.int16)
+            categories[col] = data[col].cat.categories.tolist()
+        elif kind is not None:
+            values = data[col].to_numpy(dtype=_STOREDTYPES[kind])
+        else:
+            continue
+        np.save(os.path.join(temppath, f"{col}.npy"), values)
+        kinds[col] = kind
+
+    with open(os.path.join(temppath, 'store.json'), 'w') as f:
+        json.dump({'start_date': str(studystartdate()), 'nrows': len(data), 'kinds': kinds, 'categories': categories}, f)
+
+    shutil.rmtree(storepath, ignore_errors=True)
+    os.replace(temppath, storepath)
+
+    return storepath
+
+
+def readextractstore(cohort, columns=None):
+    # opens the numpy column store of the extract for cohort as a dataframe whose columns are memory-mapped, read-only arrays
+    # dates are encoded int32 day offsets, as accepted by timetoevent, eventcountdf and the other functions in functions.py,
+    # flags, floats and dates are the memory-mapped arrays themselves, with no copy,
+    # and integers (as Int32) and categoricals are built on them, with only a missing-value mask or small code copy
+    # columns is an optional list of columns to open
+    # each column is its own block (consolidating them would copy the mapped files into memory),
+    # so take a copy() of the columns needed before adding many new columns to the frame
+
+    storepath = extractstorepath(cohort)
+    with open(os.path.join(storepath, 'store.json')) as f:
+        meta = json.load(f)
+
+    if np.datetime64(meta['start_date'], 'D') != studystartdate():
+        raise ValueError(f"{storepath} has dates encoded from a different start_date, so needs rewriting with writeextractstore")
+
+    data = {}
+    for col, kind in meta['kinds'].items():
+        if columns is not None and col not in columns:
+            continue
+        values = np.load(os.path.join(storepath, f"{col}.npy"), mmap_mode='r')
+        if kind == 'int':
+            data[col] = pd.arrays.IntegerArray(values, values == np.iinfo(np.int32).min)
+        elif kind == 'category':
+            data[col] = pd.Categorical.from_codes(values, meta['categories'][col])
+        else:
+            data[col] = values
+
+    return pd.DataFrame(data, copy=False)
+
+
+## bit-packed flags, with every 0/1 column of a patient (eg the ~30 comorbidity binary_flags) in the bits of one uint64
+## packflags returns the packed flags as a uint64 series, and records its flag name: bit map in .attrs['flagbits'],
+## keyed by the packed column's name, on both the series and the dataframe it was packed from
+## columns taken from a dataframe share its attrs, which are also kept by filtering and by to_parquet/read_parquet,
+## so the map stays with the packed column once it is in the cohort dataframe
+## the packed column's .bitflags accessor counts and tests named flags with bitwise operations on the whole column at once
+## (the column and accessor avoid the name flags, which pandas already uses for DataFrame.flags and Series.flags), eg
+##   data['packedflags'] = packflags(data, comorbidities)
+##   data['multimorbidity'] = data['packedflags'].bitflags.count()
+##   data[data['packedflags'].bitflags.any(['diabetes', 'dialysis'])]
+## where attrs are lost (eg by merge), the map can be passed to the accessor's methods as flagbits
+
+
+_FLAGBITS = 64
+
+
+def _popcount(values):
+    # number of set bits in each element of a uint64 array
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    # numpy < 2: sum the bits in pairs, then fours, then bytes, then add the bytes with a multiply
+    values = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    values = (values & np.uint64(0x3333333333333333)) + ((values >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    values = (values + (values >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return ((values * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.uint8)
+
+
+def packflags(data, columns=None, name='packedflags'):
+    # takes a dataframe and packs its flag columns into one uint64 per row, bit k being 1 where columns[k] is nonzero
+    # (missing values count as 0), and returns it as a series called name with the same index
+    # the dict of column name: bit number is added to .attrs['flagbits'][name] of the series and, in place, of data:
+    # this is packflags' one side effect, and is intended, as it is how data[name] finds its map once assigned to data
+    # (assigning a series to a column does not copy the series' attrs to the dataframe)
+    # columns defaults to every uint8 or bool column, which are the flags from readextract and readextractstore
+
+    if columns is None:
+        columns = [col for col in data.columns if data[col].dtype in (np.uint8, np.bool_)]
+    columns = list(columns)
+    if len(columns) > _FLAGBITS:
+        raise ValueError(f"can only pack {_FLAGBITS} flags into a uint64, not {len(columns)}")
+
+    packed = np.zeros(len(data), dtype=np.uint64)
+    for bit, col in enumerate(columns):
+        isset = data[col].to_numpy(dtype=np.float32, na_value=0) != 0
+        packed |= isset.astype(np.uint64) << np.uint64(bit)
+
+    flagbits = {col: bit for bit, col in enumerate(columns)}
+    data.attrs['flagbits'] = {**data.attrs.get('flagbits', {}), name: flagbits}
+
+    packed = pd.Series(packed, index=data.index, name=name)
+    packed.attrs['flagbits'] = {name: flagbits}
+    return packed
+
+
+def flagmask(flagbits, names):
+    # uint64 with the bits of the named flags set
+    names = [names] if isinstance(names, str) else names
+    missing = [name for name in names if name not in flagbits]
+    if missing:
+        raise KeyError(f"not packed flags: {', '.join(missing)}")
+    return np.uint64(sum(1 << flagbits[name] for name in names))
+
+
+def unpackflags(packed, flagbits, names=None):
+    # takes packed flags and their name: bit map and returns a dataframe of uint8 flag columns, as read by readextract
+    # names is an optional list of flags to unpack (default all)
+
+    values = np.asarray(packed, dtype=np.uint64)
+    names = list(flagbits) if names is None else names
+    data = {
+        name: ((values >> np.uint64(flagbits[name])) & np.uint64(1)).astype(np.uint8)
+        for name in names
+    }
+    return pd.DataFrame(data, index=getattr(packed, 'index', None), copy=False)
+
+
+@pd.api.extensions.register_series_accessor('bitflags')
+class FlagAccessor:
+    # packed.bitflags on a column of packed flags: names and bits are from .attrs['flagbits'][packed.name],
+    # as recorded by packflags, or from the flagbits argument of each method
+    # names arguments are a flag name or list of names, and default to every packed flag
+
+    def __init__(self, series):
+        if series.dtype != np.uint64:
+            raise AttributeError("the bitflags accessor is for uint64 series of packed flags, from packflags")
+        self._series = series
+
+    @property
+    def bits(self):
+        # the flag name: bit map of the packed column
+        return self._bits()
+
+    def _bits(self, flagbits=None):
+        if flagbits is not None:
+            return flagbits
+        name = self._series.name
+        if name not in self._series.attrs.get('flagbits', {}):
+            raise ValueError(
+                f"no flag names for packed column {name!r} in .attrs['flagbits']; "
+                "pass the flagbits map from packflags"
+            )
+        return self._series.attrs['flagbits'][name]
+
+    def _masked(self, names, flagbits):
+        flagbits = self._bits(flagbits)
+        values = self._series.to_numpy()
+        mask = flagmask(flagbits, list(flagbits) if names is None else names)
+        return values & mask, mask
+
+    def _result(self, values, name):
+        return pd.Series(values, index=self._series.index, name=name)
+
+    def __getitem__(self, name):
+        # one flag, as a boolean series
+        return self._result((self._series.to_numpy() & flagmask(self._bits(), name)) != 0, name)
+
+    def count(self, names=None, flagbits=None):
+        # number of the named flags that are set, eg the number of comorbidities (multimorbidity count)
+        values, mask = self._masked(names, flagbits)
+        return self._result(_popcount(values), 'count')
+
+    def any(self, names=None, flagbits=None):
+        # whether any of the named flags is set
+        values, mask = self._masked(names, flagbits)
+        return self._result(values != 0, 'any')
+
+    def all(self, names=None, flagbits=None):
+        # whether all of the named flags are set
+        values, mask = self._masked(names, flagbits)
+        return self._result(values == mask, 'all')
+
+    def unpack(self, names=None, flagbits=None):
+        # the named flags as uint8 columns, as in unpackflags
+        return unpackflags(self._series, self._bits(flagbits), names)
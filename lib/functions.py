@@ -1,11 +1,357 @@
 import pandas as pd
 import numpy as np
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from statistics import NormalDist
    
+
+
+## day-offset encoding of extract dates
+## dates are stored as int16 (or int32, if needed) days from the study start_date in analysis/global-variables.json,
+## with the smallest value of the integer type marking a missing date
+## this takes a quarter (or half) of the memory of datetime64[ns], 
+## and the functions below accept encoded columns wherever they accept dates
+
+def studystartdate():
+    # the study start_date from analysis/global-variables.json, as datetime64[D]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analysis', 'global-variables.json')
+    with open(path) as f:
+        gbl_vars = json.load(f)
+    return np.datetime64(gbl_vars["start_date"], 'D')
+
+
+def isencoded(dates):
+    # True if dates (a series) holds encoded day offsets rather than dates
+    # encodeseries always gives a signed numpy integer dtype (int16 or int32), so unsigned flags (eg uint8)
+    # and nullable extension integers (eg Int32) are not taken as encoded dates
+    return isinstance(dates.dtype, np.dtype) and dates.dtype.kind == 'i'
+
+
+def _todays(dates):
+    # days since the study start_date of dates (a series of encoded day offsets, datetimes, or YYYY-MM-DD strings)
+    # as an int64 array, and a boolean array marking missing dates
+    
+    if isencoded(dates):
+        values = dates.to_numpy()
+        missing = values == np.iinfo(values.dtype).min
+        return values.astype(np.int64), missing
+    
+    if pd.api.types.is_datetime64_dtype(dates.dtype):
+        values = dates.to_numpy(dtype='datetime64[D]')
+        missing = np.isnat(values)
+        days = values.view(np.int64)
+    else:
+        days, missing = _parseymd(dates)
+    
+    return days - studystartdate().astype(np.int64), missing
+
+
+def parsedates(dates):
+    # parses YYYY-MM-DD dates (a series or array of strings or bytes, or a categorical of strings) as datetime64[D],
+    # with empty or missing strings as NaT
+    # encodeseries parses strings the same way, for day offsets from the study start_date instead
+    
+    days, missing = _parseymd(dates)
+    values = days.astype('datetime64[D]')
+    values[missing] = np.datetime64('NaT')
+    return values
+
+
+def _parseymd(dates):
+    # days since 1970-01-01 of YYYY-MM-DD strings, as an int64 array, and a boolean array marking missing (empty or NA) strings
+    # every date is put in one byte buffer and its fixed-width year, month and day digits are read as (dates x 10) uint8,
+    # rather than parsing the strings one at a time
+    # categoricals (eg from read_csv with dtype='category') parse only their categories
+    
+    if isinstance(getattr(dates, 'dtype', None), pd.CategoricalDtype):
+        categorical = dates.array if isinstance(dates, pd.Series) else dates
+        category_days, category_missing = _parseymd(np.asarray(categorical.categories, dtype=object))
+        # code -1 (missing) picks the appended missing value
+        codes = categorical.codes
+        return np.append(category_days, 0)[codes], np.append(category_missing, True)[codes]
+    
+    values = np.asarray(dates)
+    if values.dtype.kind == 'S':
+        missing = values == b''
+        fields = values[~missing].view(np.uint8).reshape(-1, values.dtype.itemsize)
+        if values.dtype.itemsize > 10 and fields[:, 10:].any():
+            raise ValueError("dates must be YYYY-MM-DD")
+        fields = np.pad(fields[:, :10], ((0, 0), (0, max(10 - values.dtype.itemsize, 0))))
+    else:
+        values = values.astype(object)
+        missing = pd.isna(values) | (values == '')
+        observed = values[~missing].tolist()
+        try:
+            buffer = ''.join(observed).encode('ascii')
+        except (TypeError, UnicodeEncodeError):
+            raise ValueError("dates must be YYYY-MM-DD strings")
+        if len(buffer) != 10 * len(observed):
+            raise ValueError("dates must be YYYY-MM-DD")
+        fields = np.frombuffer(buffer, dtype=np.uint8).reshape(-1, 10)
+    
+    digits = fields[:, [0, 1, 2, 3, 5, 6, 8, 9]].astype(np.int64) - ord('0')
+    year = digits[:, 0]*1000 + digits[:, 1]*100 + digits[:, 2]*10 + digits[:, 3]
+    month = digits[:, 4]*10 + digits[:, 5]
+    day = digits[:, 6]*10 + digits[:, 7]
+    
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    monthdays = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[np.clip(month, 0, 12)] + (leap & (month == 2))
+    valid = (
+        (fields[:, 4] == ord('-')) & (fields[:, 7] == ord('-')) & ((digits >= 0) & (digits <= 9)).all(axis=1)
+        & (month >= 1) & (month <= 12) & (day >= 1) & (day <= monthdays)
+    )
+    if not valid.all():
+        example = bytes(fields[np.argmin(valid)]).decode('ascii', errors='replace')
+        raise ValueError(f"dates must be YYYY-MM-DD, not {example!r}")
+    
+    # days since 1970-01-01 counted from march 1st of year 0, in 400-year eras, so leap days fall at the end of each year
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    
+    days = np.zeros(len(values), dtype=np.int64)
+    days[~missing] = era * 146097 + day_of_era - 719468
+    return days, missing
+
+
+def encodeseries(dates, dtype=None):
+    # encodes a series of dates (datetimes or YYYY-MM-DD strings) as day offsets from the study start_date
+    # dtype is int16 if every date fits, otherwise int32, unless given
+    
+    if isencoded(dates):
+        return dates
+    
+    days, missing = _todays(dates)
+    
+    return pd.Series(_encodedays(days, missing, dtype), index=dates.index, name=dates.name)
+
+
+def _encodedays(days, missing, dtype=None):
+    # encodes int64 day offsets (from _todays) as dtype, with missing days as the smallest value of dtype
+    # dtype is chosen by _daysdtype unless given
+    if dtype is None:
+        dtype = _daysdtype(days, missing)
+    days = days.astype(dtype)
+    days[missing] = np.iinfo(dtype).min
+    return days
+
+
+def _daysdtype(days, missing):
+    # int16 if every non-missing day offset fits in it (above its missing value), otherwise int32
+    observed = days[~missing]
+    fits16 = observed.size == 0 or (observed.min() > np.iinfo(np.int16).min and observed.max() <= np.iinfo(np.int16).max)
+    return np.int16 if fits16 else np.int32
+
+
+def encodedates(df, columns=None):
+    # takes a dataframe of extract variables and returns a copy with each date column encoded by encodeseries
+    # columns defaults to every column whose name ends in _date
+    
+    if columns is None:
+        columns = [col for col in df.columns if str(col).endswith('_date')]
+    
+    encoded = df.copy()
+    for col in columns:
+        encoded[col] = encodeseries(df[col])
+    
+    return encoded
+
+
+def decodedates(dates, columns=None):
+    # converts encoded day offsets (a series, or the date columns of a dataframe) back to datetime64 dates
+    # for a dataframe, columns defaults to every column whose name ends in _date, as in encodedates
+    
+    if isinstance(dates, pd.DataFrame):
+        if columns is None:
+            columns = [col for col in dates.columns if str(col).endswith('_date')]
+        decoded = dates.copy()
+        for col in columns:
+            decoded[col] = decodedates(dates[col])
+        return decoded
+    
+    if not isencoded(dates):
+        return dates
+    
+    days, missing = _todays(dates)
+    values = (studystartdate() + days).astype('datetime64[ns]')
+    values[missing] = np.datetime64('NaT')
+    
+    return pd.Series(values, index=dates.index, name=dates.name)
+
+
+## process-pool parallelism
+## with n_jobs > 1, eventcountdf, timetoevent and KMestimategroup copy their input columns once into shared memory,
+## and worker processes attach to those arrays rather than receiving pickled dataframes
+## work is split into a fixed number of shards and results are merged in shard order,
+## so the output is the same as with n_jobs=1
+
+def _toshared(arrays):
+    # copies each array in arrays (a dict of numpy arrays) into a new block of shared memory
+    # and returns the blocks, and a dict of (block name, shape, dtype) that workers attach to with _fromshared
     
-def eventcountdf(event_dates, date_range, rule='D', popadjust=False):
+    blocks = []
+    specs = {}
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[key] = (block.name, array.shape, array.dtype.str)
+    
+    return blocks, specs
+
+
+def _fromshared(specs):
+    # attaches to the shared memory described by specs (from _toshared)
+    # and returns the blocks, and a dict of numpy arrays backed by them
+    # the arrays must be deleted before the blocks are closed
+    
+    blocks = {key: shared_memory.SharedMemory(name=name) for key, (name, _, _) in specs.items()}
+    arrays = {
+        key: np.ndarray(shape, dtype=np.dtype(dtype), buffer=blocks[key].buf) 
+        for key, (_, shape, dtype) in specs.items()
+    }
+    
+    return blocks, arrays
+
+
+def _closeshared(blocks, arrays):
+    # detaches a worker from shared memory attached with _fromshared
+    arrays.clear()
+    for block in blocks.values():
+        block.close()
+
+
+def _runshared(func, arrays, tasks, n_jobs, outputs=()):
+    # puts arrays (a dict of numpy arrays) in shared memory and runs func(specs, *task) for each task in n_jobs processes
+    # returns the results in the order of tasks, and copies of the arrays named in outputs,
+    # which workers can fill in place (eg each its own slice of rows)
+    
+    blocks, specs = _toshared(arrays)
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(func, [specs] * len(tasks), *zip(*tasks)))
+        outputs = {
+            key: np.ndarray(specs[key][1], dtype=np.dtype(specs[key][2]), buffer=block.buf).copy()
+            for key, block in zip(specs, blocks) if key in outputs
+        }
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    
+    return results, outputs
+
+
+def _rowshards(n, n_jobs):
+    # (first, last) row bounds splitting n rows into n_jobs contiguous shards
+    bounds = np.linspace(0, n, n_jobs + 1).astype(np.int64)
+    return [(first, last) for first, last in zip(bounds[:-1], bounds[1:])]
+
+
+def _groupshards(codes, n_jobs):
+    # assigns each group code to one of n_jobs shards, largest groups first to the shard with fewest records,
+    # and returns the shard of each group
+    sizes = np.bincount(codes)
+    shard = np.zeros(sizes.size, dtype=np.int64)
+    load = np.zeros(n_jobs, dtype=np.int64)
+    for code in np.argsort(-sizes, kind='stable'):
+        shard[code] = np.argmin(load)
+        load[shard[code]] += sizes[code]
+    return shard
+
+
+
+def eventcountdf(event_dates, date_range, rule='D', popadjust=False, n_jobs=1):
     # to calculate the daily count for events recorded in a dataframe
-    # where event_dates is a dataframe of date columns
+    # where event_dates is a dataframe of date columns (datetimes, day offsets from encodedates, or YYYY-MM-DD strings)
     # set popadjust = 1000, say, to report counts per 1000 population
+    # when date_range is indexed by consecutive days, all columns are counted in one pass
+    # into a (days x columns) matrix, which is then resampled and adjusted directly
+    # with n_jobs > 1, the rows are counted in n_jobs shards in parallel and the shards' matrices summed
+    
+    ndays = len(date_range.index)
+    
+    # only fixed-width columns can be put in shared memory, so strings are counted serially
+    fixedwidth = all(isencoded(event_dates[col]) or pd.api.types.is_datetime64_dtype(event_dates[col]) for col in event_dates)
+    
+    if n_jobs > 1 and event_dates.shape[1] > 0 and fixedwidth and _dayoffsets(event_dates.iloc[:0], date_range.index) is not None:
+        arrays = {j: event_dates.iloc[:, j].to_numpy() for j in range(event_dates.shape[1])}
+        tasks = [(first, last, date_range.index[0], ndays) for first, last in _rowshards(len(event_dates), n_jobs)]
+        matrices, _ = _runshared(_eventcountchunk, arrays, tasks, n_jobs)
+        matrix = None if any(m is None for m in matrices) else sum(matrices)
+    else:
+        days = _dayoffsets(event_dates, date_range.index)
+        matrix = None if days is None or event_dates.shape[1] == 0 else _countmatrix(days, ndays)
+    
+    if matrix is None:
+        return _eventcountdfbycolumn(decodedates(event_dates), date_range, rule, popadjust)
+    
+    counts = _eventcounttable(matrix, event_dates.columns, event_dates.shape[0], date_range, rule, popadjust)
+    if counts is None:
+        return _eventcountdfbycolumn(decodedates(event_dates), date_range, rule, popadjust)
+    
+    return(counts)
+
+
+def _eventcounttable(matrix, columns, pop, date_range, rule='D', popadjust=False):
+    # eventcountdf output from a (days x columns) matrix of daily counts over date_range,
+    # for a population of pop records
+    # returns None if the matrix cannot be resampled to rule
+    
+    index = date_range.index
+    if rule != "D":
+        resampled = _resampledays(matrix, index, rule)
+        if resampled is None:
+            return None
+        matrix, index = resampled
+    
+    if popadjust is not False:
+        poppern = pop/popadjust
+        matrix = matrix / poppern
+    
+    counts = pd.DataFrame(matrix, index=index, columns=columns)
+    
+    # keep any columns already in date_range, as the column-by-column version does
+    if date_range.shape[1] > 0:
+        extra = date_range.fillna(0)
+        if rule != "D":
+            extra = extra.resample(rule).sum()
+        if popadjust is not False:
+            extra = extra.transform(lambda x: x/poppern)
+        counts = extra.join(counts)
+    
+    return counts
+
+
+def _countmatrix(days, ndays):
+    # (days x columns) counts of a (records x columns) array of day offsets, ignoring those outside 0 to ndays-1
+    # days outside the range (and missing dates, at -1) go to an extra first or last row, which is dropped
+    ncols = days.shape[1]
+    key = (np.clip(days, -1, ndays) + 1) * ncols + np.arange(ncols)
+    return np.bincount(key.ravel(), minlength=(ndays + 2) * ncols).reshape(ndays + 2, ncols)[1:-1]
+
+
+def _eventcountchunk(specs, first, last, firstday, ndays):
+    # eventcountdf worker: the count matrix of rows first to last-1 of the date columns in shared memory,
+    # or None if they cannot be counted by day offset
+    blocks, arrays = _fromshared(specs)
+    try:
+        dates = pd.DataFrame({key: array[first:last] for key, array in arrays.items()})
+        days = _dayoffsets(dates, pd.date_range(firstday, periods=ndays, freq='D'))
+        del dates
+        return None if days is None else _countmatrix(days, ndays)
+    finally:
+        _closeshared(blocks, arrays)
+
+
+
+def _eventcountdfbycolumn(event_dates, date_range, rule='D', popadjust=False):
+    # eventcountdf for date ranges that are not consecutive days, one groupby per column
     
     # initialise dataset
     counts = date_range
@@ -32,17 +378,40 @@ def eventcountdf(event_dates, date_range, rule='D', popadjust=False):
         counts = counts.transform(lambda x: x/poppern)
     
     return(counts)
+
+
+
+def _resampledays(matrix, index, rule):
+    # sums the rows of a (days x columns) matrix indexed by consecutive days into the periods of rule,
+    # labelled as pandas resample labels them
+    # returns None for rules finer than a day, which would need empty periods
+    
+    firstday = pd.Series(np.arange(len(index)), index=index).resample(rule).min()
+    if firstday.isna().any():
+        return None
+    
+    return np.add.reduceat(matrix, firstday.to_numpy().astype(np.int64), axis=0), firstday.index
    
 
 
 def eventcountseries(event_dates, date_range, rule='D', popadjust=False):
     # to calculate the daily count for events recorded in a series
-    # where event_dates is a series
+    # where event_dates is a series (of datetimes, day offsets from encodeseries, or YYYY-MM-DD strings)
     # set popadjust = 1000, say, to report counts per 1000 population
+    # when date_range is indexed by consecutive days, events are counted by day offset with np.bincount
     
     pop = event_dates.size
     
-    counts = event_dates.value_counts().reindex(date_range.index, fill_value=0)
+    days = _dayoffsets(event_dates, date_range.index)
+    if days is not None:
+        inrange = (days >= 0) & (days < len(date_range.index))
+        counts = pd.Series(
+            np.bincount(days[inrange], minlength=len(date_range.index)), 
+            index=date_range.index, 
+            name=event_dates.name
+        )
+    else:
+        counts = decodedates(event_dates).value_counts().reindex(date_range.index, fill_value=0)
         
     if rule != "D":
         counts = counts.resample(rule).sum()
@@ -56,90 +425,1278 @@ def eventcountseries(event_dates, date_range, rule='D', popadjust=False):
 
 
 
+def extractpath(cohort):
+    # path of the cohortextractor output for cohort (eg "over80s"), output/input_<cohort>.csv.gz
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'output', f"input_{cohort}.csv.gz")
+
+
+def eventcountdfcsv(path, columns, date_range, rule='D', popadjust=False, chunksize=10**6):
+    # eventcountdf for date columns (=columns) of an extract csv (eg extractpath("over80s")) too big to load at once
+    # reads chunksize rows at a time, parsing only the date columns, and adds each chunk's daily counts to a
+    # (days x columns) matrix, so memory is bounded by the chunk size rather than the size of the extract
+    # date_range must be indexed by consecutive days
+    
+    columns = list(columns)
+    ndays = len(date_range.index)
+    if _dayoffsets(pd.Series([], dtype='datetime64[ns]'), date_range.index) is None:
+        raise ValueError("date_range must be indexed by consecutive days")
+    
+    matrix = np.zeros((ndays, len(columns)), dtype=np.int64)
+    pop = 0
+    # dates are read as categoricals, so each distinct date string is parsed once per chunk
+    for chunk in pd.read_csv(path, usecols=columns, dtype='category', chunksize=chunksize):
+        matrix += _countmatrix(_dayoffsets(chunk[columns], date_range.index), ndays)
+        pop += len(chunk)
+    
+    counts = _eventcounttable(matrix, pd.Index(columns), pop, date_range, rule, popadjust)
+    if counts is None:
+        raise ValueError(f"cannot resample daily counts to rule={rule}")
+    
+    return counts
+
+
+def eventcountseriescsv(path, column, date_range, rule='D', popadjust=False, chunksize=10**6):
+    # eventcountseries for one date column of an extract csv, read chunksize rows at a time as in eventcountdfcsv
+    return eventcountdfcsv(path, [column], date_range[[]], rule, popadjust, chunksize)[column]
+
 
 
+def _dayoffsets(dates, index):
+    # integer day offsets of dates (a series, or dataframe, of datetimes or encoded day offsets) from the first day of index
+    # returns None unless index is consecutive whole days and dates are all whole days,
+    # so that counting by offset matches counting by exact date
+    # missing dates get an offset of -1
+    
+    if not isinstance(index, pd.DatetimeIndex) or len(index) == 0:
+        return None
+    
+    oneday = np.timedelta64(1, 'D')
+    index_values = index.values
+    if (index_values[0] - index_values[0].astype('datetime64[D]')) != np.timedelta64(0):
+        return None
+    if not np.all(np.diff(index_values) == oneday):
+        return None
+    
+    if isinstance(dates, pd.DataFrame):
+        if not all(pd.api.types.is_datetime64_dtype(dtype) for dtype in dates.dtypes):
+            # encoded (or mixed) columns are offset one at a time
+            offsets = [_dayoffsets(dates.iloc[:, j], index) for j in range(dates.shape[1])]
+            if any(days is None for days in offsets):
+                return None
+            return np.column_stack(offsets) if offsets else np.zeros((len(dates), 0), dtype=np.int64)
+    elif isencoded(dates) or pd.api.types.is_string_dtype(dates.dtype) or isinstance(dates.dtype, pd.CategoricalDtype):
+        # encoded day offsets, or YYYY-MM-DD strings parsed by _parseymd
+        days, missing = _todays(dates)
+        days -= (index_values[0].astype('datetime64[D]') - studystartdate()).astype(np.int64)
+        days[missing] = -1
+        return days
+    elif not pd.api.types.is_datetime64_dtype(dates):
+        return None
+    
+    # integer division in the columns' own time unit is much faster than timedelta64 arithmetic
+    values = dates.to_numpy()
+    if values.dtype.kind != 'M':
+        values = dates.to_numpy(dtype='datetime64[ns]')
+    oneday = np.timedelta64(1, 'D') // np.timedelta64(1, np.datetime_data(values.dtype)[0])
+    values = values.view(np.int64)
+    missing = values == np.iinfo(np.int64).min
+    
+    days = values // oneday
+    if not np.all((days * oneday == values) | missing):
+        return None
+    
+    days -= index_values[0].astype('datetime64[D]').astype(np.int64)
+    days[missing] = -1
+    return days
+
 
 
-def timetoevent(df, origindate, eventdate, censordate):
+def timetoevent(df, origindate, eventdate, censordate, n_jobs=1):
     # takes a dataframe (df) with columns (origindate, eventdate, censordate)
-    # and outputs censored time to event series
-        
-    data = df[[origindate, eventdate, censordate]]
-    data1 = data
+    # and outputs censored time to event series:
+    # the earlier of the event and censor dates, the time in days from origin to that date, 
+    # and an indicator (1=event on or before the censor date, 0=censored)
+    # date columns can be datetimes or encoded day offsets, and the returned date is encoded if eventdate is
+    # with n_jobs > 1, the rows are split into n_jobs shards, each filling its own rows of the outputs in parallel
+    
+    columns = (origindate, eventdate, censordate)
+    
+    if n_jobs > 1 and all(isencoded(df[col]) or pd.api.types.is_datetime64_dtype(df[col]) for col in columns):
+        arrays = {col: df[col].to_numpy() for col in set(columns)}
+        arrays.update({
+            'days': np.empty(len(df), dtype=np.int64),
+            'days_missing': np.empty(len(df), dtype=bool),
+            'time': np.empty(len(df), dtype=np.float64),
+            'indicator': np.empty(len(df), dtype=bool),
+        })
+        tasks = [(first, last, columns) for first, last in _rowshards(len(df), n_jobs)]
+        _, outputs = _runshared(_timetoeventchunk, arrays, tasks, n_jobs, outputs=('days', 'days_missing', 'time', 'indicator'))
+        days, days_missing, time, indicator = (outputs[key] for key in ('days', 'days_missing', 'time', 'indicator'))
+    else:
+        days, days_missing, time, indicator = _timetoeventdays(df[origindate], df[eventdate], df[censordate])
+    
+    if isencoded(df[eventdate]):
+        dtype = df[eventdate].dtype
+        date = days.astype(dtype)
+        date[days_missing] = np.iinfo(dtype).min
+    else:
+        date = (studystartdate() + days).astype('datetime64[ns]')
+        date[days_missing] = np.datetime64('NaT')
+    
+    return (
+        pd.Series(date, index=df.index, name='date'), 
+        pd.Series(time, index=df.index, name='time'), 
+        pd.Series(indicator.astype(np.int64), index=df.index, name='indicator')
+    )
 
-    data1['date'] = data[eventdate]
-    data1['censor_date'] = data[censordate]
-    data1['date'] = data1['date'].where(data1['date'] > data1['censor_date'], data1['censor_date'])
-    data1['origin_date'] = data[origindate]
-    data1['indicator'] = np.where((data1['date']<=data1['censor_date']), 1, 0)
-    data1['time'] = (data1['date'] - data1['origin_date']).astype('timedelta64[D]')
 
-    return data1["date"], data1["time"], data1["indicator"]
+def _timetoeventdays(origindates, eventdates, censordates):
+    # timetoevent for three date series, as arrays: 
+    # days since the study start_date of the earlier of the event and censor dates, whether that is missing,
+    # time from origin, and the event indicator
+    
+    origin, origin_missing = _todays(origindates)
+    event, event_missing = _todays(eventdates)
+    censor, censor_missing = _todays(censordates)
+    
+    indicator = ~event_missing & ~censor_missing & (event <= censor)
+    days = np.where(indicator, event, censor)
+    days_missing = np.where(indicator, event_missing, censor_missing)
+    
+    time = (days - origin).astype(np.float64)
+    time[days_missing | origin_missing] = np.nan
+    
+    return days, days_missing, time, indicator
 
 
-def KMestimate(time, indicator):   
+def _timetoeventchunk(specs, first, last, columns):
+    # timetoevent worker: fills rows first to last-1 of the output arrays in shared memory
+    # from the same rows of the (origin, event, censor) date columns
+    blocks, arrays = _fromshared(specs)
+    try:
+        results = _timetoeventdays(*(pd.Series(arrays[col][first:last]) for col in columns))
+        for key, result in zip(('days', 'days_missing', 'time', 'indicator'), results):
+            arrays[key][first:last] = result
+        del results
+    finally:
+        _closeshared(blocks, arrays)
+
+
+def timetoevents(df, origindate, eventdates, censordate):
+    # as timetoevent, for a list of event date columns (eventdates) sharing the same origin and censor dates
+    # and returns (times, indicators) as (events x records) arrays, so each event's times are a contiguous row:
+    # times are float64 days from origin (nan if missing) and indicators are int8 (1=event, 0=censored)
+    # origin and censor dates are converted once, and no intermediate dataframes are built
+    
+    origin, origin_missing = _todays(df[origindate])
+    censor, censor_missing = _todays(df[censordate])
+    
+    times = np.empty((len(eventdates), len(df)), dtype=np.float64)
+    indicators = np.empty((len(eventdates), len(df)), dtype=np.int8)
+    
+    # censoring time is the same for every event, so is computed once
+    censor_time = (censor - origin).astype(np.float64)
+    censor_time[censor_missing | origin_missing] = np.nan
+    
+    for k, eventdate in enumerate(eventdates):
+        event, event_missing = _todays(df[eventdate])
+        indicator = ~event_missing & ~censor_missing & (event <= censor)
+        np.subtract(event, origin, out=times[k], where=indicator, casting='unsafe')
+        np.copyto(times[k], censor_time, where=~indicator)
+        times[k][indicator & origin_missing] = np.nan
+        indicators[k] = indicator
+    
+    return times, indicators
+
+
+def KMcounts(time, indicator, weights=None):
+    # takes event times (=time) and a censor indicator (=indicator, 1=event, 0=censor)
+    # and returns the distinct times with the number of records, events and censorings at each
+    # if weights are given, the counts are sums of weights
+    # this is KMgroupcounts with every record in one group
+    
+    return KMgroupcounts(time, indicator, None, weights)[1:]
+
+
+# largest number of bins counted directly by _daybins and KMgroupcounts, regardless of the number of records
+_MAXBINS = 2**20
 
-    ## function that takes event times (=time, a series) and a censor indicator (=indicator, a series taking values 1=event, 0=censor)
-    ## and produces kaplan meier estimates in a dataframe
 
-    time = np.array(time)
-    indicator = np.array(indicator)
-    sortinds = time.argsort()
-    time = time[sortinds]
-    indicators = indicator[sortinds]
+def _daybins(time):
+    # returns (min time, time - min time as int64) if time takes whole-number values
+    # over a range that can be counted with np.bincount, or None to fall back to sorting
+    
+    if time.size == 0 or not (np.issubdtype(time.dtype, np.integer) or np.issubdtype(time.dtype, np.floating)):
+        return None
+    
+    tmin = time.min()
+    tmax = time.max()
+    if not (np.isfinite(tmin) and np.isfinite(tmax)):
+        return None
+    if float(tmax) - float(tmin) >= max(_MAXBINS, time.size):
+        return None
+    if np.issubdtype(time.dtype, np.floating) and not np.all(time == np.floor(time)):
+        return None
+    
+    offset = time.astype(np.int64) - np.int64(tmin)
+    return tmin, offset
 
-    min_time = 0
-    max_time = time.max()
-    atrisk0 = len(time)
 
-    unq_times, count = np.unique(time, return_counts=True)
-    event_time, event_count = np.unique(time[indicator==1], return_counts=True)
-    censor_time, censor_count = np.unique(time[indicator==0], return_counts=True)
+def _distinctindex(time, groupcodes):
+    # sorts records by (group, time) once and returns the group code and time of each distinct (group, time),
+    # and the index of each record's (group, time) among them, for counting with np.bincount
+    # whole-number times in a small range are binned directly rather than sorted
+    # groupcodes can be None for records all in one group
+    
+    time = np.asarray(time)
+    if groupcodes is not None:
+        groupcodes = np.asarray(groupcodes)
+    
+    bins = _daybins(time)
+    if bins is not None and time.size > 0:
+        tmin, offset = bins
+        span = offset.max() + 1
+        ngroups = 1 if groupcodes is None else groupcodes.max() + 1
+        if ngroups * span <= max(_MAXBINS, time.size):
+            key = offset if groupcodes is None else groupcodes.astype(np.int64) * span + offset
+            occupied = np.bincount(key, minlength=ngroups*span) > 0
+            unq_key = np.flatnonzero(occupied)
+            inverse = (np.cumsum(occupied) - 1)[key]
+            unq_times = (tmin + unq_key % span).astype(time.dtype)
+            return unq_key // span, unq_times, inverse
+    
+    if groupcodes is None:
+        groupcodes = np.zeros(time.size, dtype=np.int64)
     
-    cml_count = count.cumsum()
-    atrisk = (atrisk0-cml_count) + count
+    sortinds = np.lexsort((time, groupcodes))
+    time_sorted = time[sortinds]
+    groupcodes_sorted = groupcodes[sortinds]
+    new = np.concatenate((
+        [True], 
+        (time_sorted[1:] != time_sorted[:-1]) | (groupcodes_sorted[1:] != groupcodes_sorted[:-1])
+    ))[:time.size]
+    
+    inverse = np.empty(time.size, dtype=np.int64)
+    inverse[sortinds] = np.cumsum(new) - 1
+    return groupcodes_sorted[new], time_sorted[new], inverse
+
+
+def KMtable(unq_times, count, n_events, censored, count2=None, n_events2=None, atrisk=None):
+    # takes per-time counts as returned by KMcounts
+    # and produces the kaplan meier estimates dataframe returned by KMestimate
+    # for weighted counts, count2 and n_events2 are the per-time sums of squared weights for all records and for events,
+    # and are used to add the variance of log(kmestimate) as var_logkm
+    # atrisk can be given for risk sets that are not everyone still in follow-up (eg with delayed entry)
+    
+    groupstart = np.zeros(min(count.size, 1), dtype=np.int64)
+    if atrisk is None:
+        atrisk = _atriskby(count, groupstart)
+    kmestimate = _KMsurvivalby(n_events, atrisk, groupstart)
 
     kmdata = pd.DataFrame({
         'time': unq_times, 
-        'atrisk': atrisk
-    }).merge(
-        pd.DataFrame({
-            'time': event_time, 
-            'n_events': event_count
-        }), on="time", how='left'
-    ).merge(
-        pd.DataFrame({
-            'time': censor_time, 
-            'censored': censor_count
-        }), on="time", how='left'
-    )
+        'atrisk': atrisk,
+        'n_events': n_events,
+        'censored': censored,
+        'kmestimate': kmestimate
+    })
+    
+    if count2 is not None:
+        kmdata['var_logkm'] = _KMvarlog(atrisk, n_events, count2, n_events2, groupstart)
+
+    return kmdata
 
-    kmdata[['n_events','censored']] = kmdata[['n_events','censored']].fillna(0)
+
+def _KMvarlog(atrisk, n_events, count2, n_events2, groupstart):
+    # infinitesimal jackknife variance of log(kmestimate) from weighted per-time counts, restarting at each groupstart
+    # each record's influence depends only on its time and status, so only per-time sums of squared weights are needed
+    # with unit weights this is close to greenwood's cumsum(n_events / ((atrisk - n_events) * atrisk))
     
+    if atrisk.size == 0:
+        return np.zeros(0)
     
-    kmdata['kmestimate'] = 1
-    for i in kmdata.index:
-        if i==0:
-            kmdata.loc[i, 'kmestimate'] = 1 * (kmdata.loc[i, 'atrisk'] - kmdata.loc[i, 'n_events'])/kmdata.loc[i, 'atrisk']
-        else:
-            kmdata.loc[i, 'kmestimate'] = kmdata.loc[i-1, 'kmestimate'] * (kmdata.loc[i, 'atrisk'] - kmdata.loc[i, 'n_events'])/kmdata.loc[i, 'atrisk']
+    lengths = np.diff(np.append(groupstart, atrisk.size))
+    total2 = np.repeat(np.add.reduceat(count2, groupstart), lengths)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cml_haz = _cumsumby(n_events / atrisk**2, groupstart)
+        # records leaving at or before each time
+        left = _cumsumby(n_events2 * (1/atrisk - cml_haz)**2 + (count2 - n_events2) * cml_haz**2, groupstart)
+        # records still at risk after each time
+        remaining = (total2 - _cumsumby(count2, groupstart)) * cml_haz**2
+    
+    return left + remaining
+
+
+def KMestimate(time, indicator, weights=None, entry=None):   
+
+    ## function that takes event times (=time, a series) and a censor indicator (=indicator, a series taking values 1=event, 0=censor)
+    ## and produces kaplan meier estimates in a dataframe
+    ## optional weights (eg from sample_weights in lib/utility_functions.R) give weighted at-risk and event counts,
+    ## and a var_logkm column with a variance that allows for the weighting
+    ## optional entry times (=entry, a series) give delayed entry: a record is at risk at t if entry < t <= time
+    ## records with time <= entry are never at risk and are dropped, and a missing entry time means no delayed entry
 
+    if weights is None and entry is None:
+        return KMtable(*KMcounts(time, indicator))
+    
+    time = np.asarray(time)
+    indicator = np.asarray(indicator)
+    keep = np.ones(time.size, dtype=bool)
+    
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+        # unsampled records (weight zero) contribute nothing
+        keep &= weights != 0
+    if entry is not None:
+        entry = _entrytimes(entry)
+        keep &= time > entry
+    
+    time, indicator = time[keep], indicator[keep]
+    if weights is not None:
+        weights = weights[keep]
+    if entry is not None:
+        entry = entry[keep]
+    
+    unq_times, count, n_events, censored = KMcounts(time, indicator, weights)
+    
+    if entry is None:
+        _, count2, n_events2, _ = KMcounts(time, indicator, weights**2)
+        return KMtable(unq_times, count, n_events, censored, count2, n_events2)
+    
+    # entered before t minus left before t, by binary search on the sorted entry and exit times
+    atrisk = _weightbelow(entry, weights, unq_times) - _weightbelow(time, weights, unq_times)
+    kmdata = KMtable(unq_times, count, n_events, censored, atrisk=atrisk)
+    
+    if weights is not None:
+        kmdata['var_logkm'] = _KMvarlogentry(unq_times, atrisk, n_events, time, indicator, entry, weights)
+    
     return kmdata
 
 
-def KMestimategroup(df, time, indicator, group):
-    # takes a dataframe (df) with columns (time, indicator, group)
-    # and outputs km esimates from KMestimate function, by group
-        
-    groups = df[group].unique()
+def _entrytimes(entry):
+    # delayed entry times as a float array, with missing entry times as -inf (at risk from the start)
+    entry = pd.array(entry).to_numpy(dtype=np.float64, na_value=np.nan)
+    entry[np.isnan(entry)] = -np.inf
+    return entry
+
+
+def _weightbelow(x, weights, points, side='left'):
+    # total weight (or number, if weights is None) of records with x < points (side='left') or x <= points (side='right')
+    sortinds = x.argsort(kind='stable')
+    if weights is None:
+        return np.searchsorted(x[sortinds], points, side=side)
+    cml_weights = np.concatenate(([0], np.cumsum(weights[sortinds])))
+    return cml_weights[np.searchsorted(x[sortinds], points, side=side)]
+
+
+def _weightbelowby(x, codes, weights, points, pointcodes):
+    # as _weightbelow (with side='left'), counting only the records whose group code is that of each point
+    # values are replaced by their ranks, so (group, rank) is one sortable integer key
+    values, ranks = np.unique(np.concatenate((x, points)), return_inverse=True)
+    key = codes.astype(np.int64) * values.size + ranks[:x.size]
+    pointkey = pointcodes.astype(np.int64) * values.size + ranks[x.size:]
+    return _weightbelow(key, weights, pointkey) - _weightbelow(key, weights, pointcodes.astype(np.int64) * values.size)
+
+
+def _KMvarlogentry(unq_times, atrisk, n_events, time, indicator, entry, weights):
+    # as _KMvarlog, for records with delayed entry
+    # a record's influence on log(kmestimate) at t_m is 
+    #   event/atrisk(T) - (H(T) - H(E)) if it left by t_m, 
+    #   -(H(t_m) - H(E)) if it is still at risk at t_m, and zero if it enters later,
+    # where H is the cumulative sum of n_events / atrisk**2, so the variance is built from 
+    # per-record terms summed by exit time, and by entry time for records still at risk
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cml_haz = np.cumsum(n_events / atrisk**2)
+    cml_haz_ = np.concatenate(([0.0], cml_haz))
+    
+    k = np.searchsorted(unq_times, time)
+    haz_entry = cml_haz_[np.searchsorted(unq_times, entry, side='right')]
+    weights2 = weights**2
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        influence_left = (indicator==1)/atrisk[k] - cml_haz[k] + haz_entry
+    left = np.cumsum(np.bincount(k, weights=weights2 * influence_left**2, minlength=unq_times.size))
+    
+    # sums of weights2 * haz_entry**p over records with entry < t_m < time, for p = 0, 1, 2
+    sums = [
+        _weightbelow(entry, weights2 * haz_entry**p, unq_times) 
+        - np.cumsum(np.bincount(k, weights=weights2 * haz_entry**p, minlength=unq_times.size))
+        for p in range(3)
+    ]
+    remaining = cml_haz**2 * sums[0] - 2 * cml_haz * sums[1] + sums[2]
+    
+    return left + remaining
+
+
+class KMaccumulator:
+    # accumulates the per-time counts needed for a kaplan meier fit, one chunk of records at a time
+    # memory is bounded by the number of distinct times, not the number of records
+    # accumulators fitted to different chunks (eg in different processes) can be combined exactly with merge
+    #
+    # usage:
+    #   acc = KMaccumulator()
+    #   for chunk in pd.read_csv(path, chunksize=10**6):
+    #       acc.update(chunk['time'], chunk['indicator'])
+    #   kmdata = acc.finalize()
+    
+    def __init__(self):
+        self.times = np.zeros(0)
+        # columns are count, n_events, censored
+        self.counts = np.zeros((0, 3), dtype=np.int64)
+    
+    def _add(self, times, counts):
+        # adds counts at (sorted, distinct) times into the accumulated counts
+        # an empty side is skipped rather than unioned, so its (default float) dtype does not change the other's times
+        if counts.shape[0] == 0:
+            return
+        if self.counts.shape[0] == 0:
+            self.times = times.copy()
+            self.counts = np.asarray(counts, dtype=np.int64).copy()
+            return
+        unq_times = np.union1d(self.times, times)
+        unq_counts = np.zeros((unq_times.size, 3), dtype=np.int64)
+        unq_counts[np.searchsorted(unq_times, self.times)] += self.counts
+        unq_counts[np.searchsorted(unq_times, times)] += counts
+        self.times = unq_times
+        self.counts = unq_counts
+    
+    def update(self, time, indicator):
+        # adds a chunk of event times and censor indicators (1=event, 0=censor)
+        unq_times, count, n_events, censored = KMcounts(time, indicator)
+        self._add(unq_times, np.column_stack((count, n_events, censored)))
+        return self
+    
+    def merge(self, other):
+        # adds the counts from another accumulator
+        self._add(other.times, other.counts)
+        return self
+    
+    def finalize(self):
+        # returns the same dataframe as KMestimate on all records seen so far
+        return KMtable(self.times, self.counts[:, 0], self.counts[:, 1], self.counts[:, 2])
+
+
+def KMsummary(kmdata, times=None, conf=0.95):
+    # takes a dataframe of kaplan meier estimates as returned by KMestimate
+    # and adds the derived quantities from tidy_surv in lib/survival_functions.R:
+    # greenwood standard errors, log(-log) confidence limits, and kaplan meier and actuarial hazards
+    # for weighted fits the standard errors use var_logkm from KMestimate instead of greenwood's formula
+    #
+    # if times is given, estimates are evaluated on that grid instead of at every distinct time:
+    # survival is the step function at each grid time, and counts are summed over [time, leadtime),
+    # with the last row covering all times from the last grid time onwards
+    # with times=None the result has one row per distinct time, as in tidy_surv
+    
+    t = kmdata['time'].to_numpy()
+    atrisk = kmdata['atrisk'].to_numpy()
+    n_events = kmdata['n_events'].to_numpy()
+    censored = kmdata['censored'].to_numpy()
+    surv = kmdata['kmestimate'].to_numpy()
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sumerand = n_events / ((atrisk - n_events) * atrisk)
+    
+    # weighted fits carry their own variance of log(kmestimate), otherwise use greenwood's formula
+    if 'var_logkm' in kmdata:
+        var_logkm = kmdata['var_logkm'].to_numpy()
+    else:
+        var_logkm = np.cumsum(sumerand)
     
-    kmdata = pd.DataFrame(columns=[group, "time", "atrisk", "n_events", "kmestimate"])
+    # step-function lookups are into arrays with a leading time-zero element
+    surv_ = np.concatenate(([1.0], surv))
+    cml_sumerand_ = np.concatenate(([0.0], var_logkm))
+    cml_events_ = np.concatenate(([0], np.cumsum(n_events)))
+    cml_censored_ = np.concatenate(([0], np.cumsum(censored)))
     
-    for g in groups:
-        data_group = df[df[group]==g]
-        kmdata_group = KMestimate(data_group[time], data_group[indicator])
-        kmdata_group[group] = g
+    if times is None:
+        grid = t
+    else:
+        grid = np.unique(np.asarray(times))
+    
+    # index into the leading-zero arrays of the last distinct time <= time, < time, and < leadtime
+    upto = np.searchsorted(t, grid, side='right')
+    before = np.searchsorted(t, grid, side='left')
+    after = np.append(before[1:], t.size)
+    
+    leadtime = np.append(grid[1:], np.nan)
+    interval = leadtime - grid
+    
+    # at risk at each grid time, and counts in [time, leadtime)
+    n_risk = np.append(atrisk, 0)[before]
+    n_event = cml_events_[after] - cml_events_[before]
+    n_censor = cml_censored_[after] - cml_censored_[before]
+    
+    surv_grid = surv_[upto]
+    cml_sumerand = cml_sumerand_[upto]
+    
+    z = NormalDist().inv_cdf(1 - (1-conf)/2)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
         
-        kmdata = kmdata.append(kmdata_group, ignore_index=True)
+        se_surv = surv_grid * np.sqrt(cml_sumerand)
+        
+        llsurv = np.log(-np.log(surv_grid))
+        se_llsurv = np.sqrt((1 / np.log(surv_grid)**2) * cml_sumerand)
+        surv_ll = np.where(surv_grid < 1, surv_grid ** np.exp(z * se_llsurv), 1.0)
+        surv_ul = np.where(surv_grid < 1, surv_grid ** np.exp(-z * se_llsurv), 1.0)
+        
+        # kaplan meier hazard: probability of an event in [time, leadtime) given at risk at time, per unit time
+        # at distinct times this is n_events / (atrisk * interval), as in tidy_surv
+        haz_km = (1 - surv_[after]/surv_[before]) / interval
+        cml_haz_km = np.cumsum(haz_km)
+        se_haz_km = haz_km * np.sqrt((n_risk - n_event) / (n_risk * n_event))
+        
+        # actuarial hazard
+        haz_ac = n_event / ((n_risk - (n_censor / 2) - (n_event / 2)) * interval)
+        cml_haz_ac = -np.log(surv_grid)
+        se_haz_ac = (haz_ac * np.sqrt(1 - (haz_ac * interval / 2)**2)) / np.sqrt(n_event)
+    
+    summary = pd.DataFrame({
+        'time': grid,
+        'leadtime': leadtime,
+        'interval': interval,
+        'atrisk': n_risk,
+        'n_events': n_event,
+        'censored': n_censor,
+        'kmestimate': surv_grid,
+        'kmestimate_ll': surv_ll,
+        'kmestimate_ul': surv_ul,
+        'se_kmestimate': se_surv,
+        'haz_km': haz_km,
+        'cml_haz_km': cml_haz_km,
+        'se_haz_km': se_haz_km,
+        'haz_ac': haz_ac,
+        'cml_haz_ac': cml_haz_ac,
+        'se_haz_ac': se_haz_ac,
+        'llsurv': llsurv,
+        'se_llsurv': se_llsurv,
+    })
+    
+    return summary
+
+
+def NAestimate(time, indicator):
+    
+    ## function that takes event times (=time, a series) and a censor indicator (=indicator, a series taking values 1=event, 0=censor)
+    ## and produces nelson-aalen cumulative hazard estimates and their variance in a dataframe
+    ## uses the same per-time counts as KMestimate
+    
+    unq_times, count, n_events, censored = KMcounts(time, indicator)
+    atrisk = _atriskby(count, np.zeros(min(count.size, 1), dtype=np.int64))
+    
+    nadata = pd.DataFrame({
+        'time': unq_times,
+        'atrisk': atrisk,
+        'n_events': n_events,
+        'censored': censored,
+        'cml_haz': np.cumsum(n_events/atrisk),
+        'var_cml_haz': np.cumsum(n_events/atrisk**2),
+    })
+    
+    return nadata
+
+
+def smoothhazard(kmdata, bandwidth, group=None):
+    # takes a dataframe with time, atrisk and n_events columns (as returned by KMestimate, KMestimategroup or NAestimate)
+    # and produces an epanechnikov kernel-smoothed hazard, with its standard error, on a daily grid
+    # bandwidth is the kernel half-width in days, and times are rounded to whole days
+    # group is the group column of KMestimategroup output, or its list of group columns
+    # the nelson-aalen increments are binned into a (groups x days) matrix and convolved with the kernel, 
+    # one shift per kernel day, so all groups are smoothed together
+    # there is no boundary correction, so estimates within bandwidth days of either end are biased downwards
+    
+    if group is None:
+        codes = np.zeros(len(kmdata), dtype=np.int64)
+        groups = None
+        ngroups = 1
+    else:
+        codes, groups = _groupcodes(kmdata, group)
+        ngroups = len(groups)
+    
+    days = np.rint(kmdata['time'].to_numpy()).astype(np.int64)
+    atrisk = kmdata['atrisk'].to_numpy()
+    n_events = kmdata['n_events'].to_numpy()
+    
+    daymin = days.min()
+    ndays = days.max() - daymin + 1
+    key = codes * ndays + (days - daymin)
+    
+    # nelson-aalen increments and their variances
+    dhaz = np.bincount(key, weights=n_events/atrisk, minlength=ngroups*ndays).reshape(ngroups, ndays)
+    dvar = np.bincount(key, weights=n_events/atrisk**2, minlength=ngroups*ndays).reshape(ngroups, ndays)
+    
+    shifts = np.arange(-bandwidth, bandwidth + 1)
+    kernel = 0.75 * (1 - (shifts/(bandwidth+1))**2) / (bandwidth+1)
+    
+    haz = np.zeros((ngroups, ndays))
+    var_haz = np.zeros((ngroups, ndays))
+    for shift, k in zip(shifts, kernel):
+        # contribution to day d of the increment at day d - shift
+        if shift >= 0:
+            haz[:, shift:] += k * dhaz[:, :ndays-shift]
+            var_haz[:, shift:] += k**2 * dvar[:, :ndays-shift]
+        else:
+            haz[:, :shift] += k * dhaz[:, -shift:]
+            var_haz[:, :shift] += k**2 * dvar[:, -shift:]
+    
+    hazdata = pd.DataFrame({
+        'time': np.tile(np.arange(daymin, daymin + ndays), ngroups),
+        'haz': haz.ravel(),
+        'se_haz': np.sqrt(var_haz.ravel()),
+    })
+    if group is not None:
+        groupcolumns = _groupcolumns(group, groups, np.arange(ngroups).repeat(ndays))
+        for k, (col, values) in enumerate(groupcolumns.items()):
+            hazdata.insert(k, col, values)
+    
+    return hazdata
+
+
+def KMgroupcounts(time, indicator, groupcodes, weights=None):
+    # as KMcounts, but for records labelled by integer group codes (=groupcodes, or None for one group)
+    # and also returns the group code of each distinct (group, time), in (group, time) order
+    # the distinct (group, time)s are found once by _distinctindex, and each count is one np.bincount over them
+    
+    indicator = np.asarray(indicator)
+    unq_groupcodes, unq_times, inverse = _distinctindex(time, groupcodes)
+    ntimes = unq_times.size
+    
+    event = indicator==1
+    censor = indicator==0
+    if weights is None:
+        count = np.bincount(inverse, minlength=ntimes)
+        n_events = np.bincount(inverse[event], minlength=ntimes)
+        censored = np.bincount(inverse[censor], minlength=ntimes)
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+        count = np.bincount(inverse, weights=weights, minlength=ntimes)
+        n_events = np.bincount(inverse[event], weights=weights[event], minlength=ntimes)
+        censored = np.bincount(inverse[censor], weights=weights[censor], minlength=ntimes)
+    
+    return unq_groupcodes, unq_times, count, n_events, censored
+
+
+def _groupcodes(df, group):
+    # integer codes (in order of first appearance) and distinct values of a group column of df,
+    # or of a list of group columns as a MultiIndex, with code -1 where any group column is missing
+    if isinstance(group, list):
+        codes, groups = pd.factorize(pd.MultiIndex.from_frame(df[group]))
+        codes[df[group].isna().any(axis=1).to_numpy()] = -1
+        return codes, groups
+    return pd.factorize(df[group])
+
+
+def _groupcolumns(group, groups, codes):
+    # output columns of group values for integer codes into groups (from _groupcodes), one per group column
+    if isinstance(group, list):
+        return {col: groups.get_level_values(j).take(codes) for j, col in enumerate(group)}
+    return {group: groups.take(codes)}
+
+
+def _groupstarts(groupcodes):
+    # index of the first element of each run of equal (sorted) group codes
+    if groupcodes.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate(([True], groupcodes[1:] != groupcodes[:-1])))
+
+
+def _cumsumby(x, groupstart):
+    # cumulative sum of x along its last axis that restarts at each index in groupstart
+    cml = np.cumsum(x, axis=-1)
+    offset = (cml - x)[..., groupstart]
+    lengths = np.diff(np.append(groupstart, x.shape[-1]))
+    return cml - np.repeat(offset, lengths, axis=-1)
+
+
+def _cumprodby(x, groupstart):
+    # cumulative product of x (>=0) along its last axis that restarts at each index in groupstart
+    # computed as a segmented sum of logs, with zero factors tracked separately
+    if groupstart.size <= 1:
+        return np.cumprod(x, axis=-1)
+    iszero = x == 0
+    nzeros = _cumsumby(iszero.astype(np.int64), groupstart)
+    logx = np.log(np.where(iszero, 1, x))
+    return np.where(nzeros > 0, 0, np.exp(_cumsumby(logx, groupstart)))
+
+
+def _atriskby(count, groupstart):
+    # number at risk at each distinct time from the per-time counts (along the last axis) of records leaving then:
+    # the records at that time or later in the same group, with groups starting at each index in groupstart
+    if count.shape[-1] == 0:
+        return count.copy()
+    lengths = np.diff(np.append(groupstart, count.shape[-1]))
+    total = np.repeat(np.add.reduceat(count, groupstart, axis=-1), lengths, axis=-1)
+    return (total - _cumsumby(count, groupstart)) + count
+
+
+def _KMsurvivalby(n_events, atrisk, groupstart):
+    # product-limit estimate at each distinct time, restarting at each index in groupstart
+    # weighted atrisk can fall a rounding error below n_events when every remaining record has the event,
+    # so factors are clipped at zero, and times with no one at risk (only in KMbootstrap replicates) have no events
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hazard = np.where(atrisk > 0, n_events/atrisk, 0)
+    return _cumprodby(np.maximum(1 - hazard, 0), groupstart)
+
+
+def KMestimategroup(df, time, indicator, group, weights=None, n_jobs=1, entry=None):
+    # takes a dataframe (df) with columns (time, indicator, group)
+    # and outputs km esimates as in KMestimate, by group
+    # all groups are fitted together from one sort by (group, time)
+    # groups are returned in order of first appearance, and records with a missing group are dropped
+    # weights is an optional column of weights, as in KMestimate
+    # entry is an optional column of delayed entry times, as in KMestimate,
+    # with each group's risk sets counted by a binary search within the group
+    # (such delayed-entry tables are not supported by KMbootstrap)
+    # with n_jobs > 1, groups are split into up to n_jobs shards of similar size, counted in parallel
+    # group can also be a list of columns (eg [stratum, group] for logrank), giving one column each in the output
+    
+    codes, groups = _groupcodes(df, group)
+    keep = codes >= 0
+    time = df[time].to_numpy()
+    if weights is not None:
+        weights = df[weights].to_numpy(dtype=np.float64)
+        keep &= weights != 0
+    if entry is not None:
+        entry = _entrytimes(df[entry])
+        keep &= time > entry
+        entry = entry[keep]
+    if weights is not None:
+        weights = weights[keep]
+    
+    time = time[keep]
+    indicator = df[indicator].to_numpy()[keep]
+    codes = codes[keep]
+    
+    nshards = min(n_jobs, len(groups))
+    if nshards > 1:
+        arrays = {'time': time, 'indicator': indicator, 'codes': codes, 'shard': _groupshards(codes, nshards)}
+        if weights is not None:
+            arrays['weights'] = weights
+        shards, _ = _runshared(_KMgroupcountschunk, arrays, [(shard,) for shard in range(nshards)], nshards)
+        # each group is in one shard, already sorted by time, so a stable sort by group restores the serial order
+        counts = [np.concatenate(parts) for parts in zip(*shards)]
+        order = np.argsort(counts[0], kind='stable')
+        counts = [array[order] for array in counts]
+    else:
+        counts = list(KMgroupcounts(time, indicator, codes, weights))
+        if weights is not None:
+            counts += KMgroupcounts(time, indicator, codes, weights**2)[2:4]
+    
+    unq_codes, unq_times, count, n_events, censored = counts[:5]
+    
+    groupstart = _groupstarts(unq_codes)
+    if entry is None:
+        atrisk = _atriskby(count, groupstart)
+    else:
+        # entered before t minus left before t, within each group
+        atrisk = (
+            _weightbelowby(entry, codes, weights, unq_times, unq_codes)
+            - _weightbelowby(time, codes, weights, unq_times, unq_codes)
+        )
+    kmestimate = _KMsurvivalby(n_events, atrisk, groupstart)
+    
+    kmdata = pd.DataFrame({
+        **_groupcolumns(group, groups, unq_codes),
+        'time': unq_times, 
+        'atrisk': atrisk,
+        'n_events': n_events,
+        'censored': censored,
+        'kmestimate': kmestimate
+    })
+    
+    if weights is not None and entry is None:
+        count2, n_events2 = counts[5:]
+        kmdata['var_logkm'] = _KMvarlog(atrisk, n_events, count2, n_events2, groupstart)
+    elif weights is not None:
+        # the delayed-entry variance is built from each record's entry and exit, so is done group by group
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+        groupend = np.append(groupstart[1:], unq_codes.size)
+        recordstart = np.searchsorted(sorted_codes, unq_codes[groupstart], side='left')
+        recordend = np.searchsorted(sorted_codes, unq_codes[groupstart], side='right')
+        kmdata['var_logkm'] = np.concatenate([np.zeros(0)] + [
+            _KMvarlogentry(
+                unq_times[first:last], atrisk[first:last], n_events[first:last],
+                *(values[order[lo:hi]] for values in (time, indicator, entry, weights))
+            )
+            for first, last, lo, hi in zip(groupstart, groupend, recordstart, recordend)
+        ])
+    
+    return kmdata
+
+
+def _KMgroupcountschunk(specs, shard):
+    # KMestimategroup worker: KMgroupcounts for the groups in one shard, from the records in shared memory
+    # plus the counts with squared weights, if weighted
+    blocks, arrays = _fromshared(specs)
+    try:
+        rows = arrays['shard'][arrays['codes']] == shard
+        weights = arrays['weights'][rows] if 'weights' in arrays else None
+        args = (arrays['time'][rows], arrays['indicator'][rows], arrays['codes'][rows])
+        counts = KMgroupcounts(*args, weights)
+        if weights is not None:
+            counts += KMgroupcounts(*args, weights**2)[2:4]
+        del args
+        return counts
+    finally:
+        _closeshared(blocks, arrays)
+
+
+
+# number of bootstrap replicates drawn from each seed, so results do not depend on n_jobs
+_BOOTCHUNK = 50
+
+
+def _KMbootstrapchunk(seed, n_boot, n_events, n_other, groupstart, kmestimate, sd):
+    # draws n_boot poisson bootstrap replicates of the per-time counts from seed (a np.random.SeedSequence)
+    # and refits kaplan meier to each, as a (replicates x times) matrix
+    # returns the sum and sum of squares of the replicates over replicates if sd is None,
+    # otherwise the (replicates x groups) maximum of |replicate - kmestimate| / sd within each group
+    
+    rng = np.random.default_rng(seed)
+    
+    # resampling each record with a poisson(1) weight gives poisson(count) records in each (time, status) cell
+    n_events_boot = rng.poisson(n_events, size=(n_boot, n_events.size))
+    count_boot = n_events_boot + rng.poisson(n_other, size=(n_boot, n_other.size))
+    
+    atrisk = _atriskby(count_boot, groupstart)
+    kmestimate_boot = _KMsurvivalby(n_events_boot, atrisk, groupstart)
+    
+    if sd is None:
+        return kmestimate_boot.sum(axis=0), (kmestimate_boot**2).sum(axis=0)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(sd > 0, np.abs(kmestimate_boot - kmestimate)/sd, 0)
+    return np.maximum.reduceat(z, groupstart, axis=-1)
+
+
+def KMbootstrap(kmdata, group=None, n_boot=500, conf=0.95, seed=None, n_jobs=1):
+    # takes a dataframe of kaplan meier estimates (from KMestimate without entry, or KMestimategroup with its group column or list of columns)
+    # and adds bootstrap standard errors (se_boot) and simultaneous confidence bands (band_ll, band_ul)
+    #
+    # replicates resample the per-time counts in kmdata rather than the patient-level data,
+    # so each replicate costs O(distinct times) however large the cohort
+    # the band is the sup-t band: kmestimate +/- q * se_boot, with q the conf quantile
+    # of the maximum over times of |replicate - kmestimate| / se_boot, within each group
+    #
+    # replicates are drawn in fixed chunks, each from its own seed spawned from seed,
+    # and chunks are spread over n_jobs processes, so results are reproducible and do not depend on n_jobs
+    #
+    # delayed-entry fits (KMestimate with entry) are not supported, as their atrisk is not from exits alone,
+    # and neither are weighted fits (with var_logkm): their counts are sums of weights, not numbers of records,
+    # so resampling them as counts misses the variance from the weights (use var_logkm, as in KMsummary, instead)
+    
+    if 'var_logkm' in kmdata:
+        raise ValueError("KMbootstrap resamples numbers of records, so cannot be used with weighted kmdata (with var_logkm)")
+    if n_boot < 2:
+        raise ValueError("KMbootstrap needs n_boot >= 2 replicates for a standard error")
+    
+    if group is None:
+        codes = np.zeros(len(kmdata), dtype=np.int64)
+    else:
+        codes = _groupcodes(kmdata, group)[0]
+    
+    groupstart = _groupstarts(codes)
+    if np.unique(codes).size != groupstart.size:
+        raise ValueError("kmdata must have each group's rows together, as returned by KMestimategroup")
+    
+    atrisk = kmdata['atrisk'].to_numpy()
+    n_events = kmdata['n_events'].to_numpy()
+    kmestimate = kmdata['kmestimate'].to_numpy()
+    
+    # records leaving at each time, from the drop in atrisk to the next time in the same group
+    atrisk_next = np.append(atrisk[1:], 0)
+    groupend = np.append(groupstart[1:], len(kmdata)) - 1
+    atrisk_next[groupend] = 0
+    n_other = atrisk - atrisk_next - n_events
+    
+    # with delayed entry (KMestimate with entry) records also join the risk set between times,
+    # and a record's entry and exit cannot be resampled independently from per-time counts
+    if not np.array_equal(n_other, kmdata['censored'].to_numpy()):
+        raise ValueError("KMbootstrap cannot be used with delayed entry: kmdata has records entering the risk set after the first time")
+    
+    seeds = np.random.SeedSequence(seed).spawn(-(-n_boot // _BOOTCHUNK))
+    sizes = [min(_BOOTCHUNK, n_boot - i*_BOOTCHUNK) for i in range(len(seeds))]
+    
+    def run(sd):
+        args = [(seed_, size, n_events, n_other, groupstart, kmestimate, sd) for seed_, size in zip(seeds, sizes)]
+        if n_jobs == 1:
+            return [_KMbootstrapchunk(*arg) for arg in args]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            return list(executor.map(_KMbootstrapchunk, *zip(*args)))
+    
+    # first pass for the bootstrap standard error, second (same seeds, so same replicates) for the band
+    sums = run(None)
+    mean_boot = sum(chunk[0] for chunk in sums) / n_boot
+    var_boot = sum(chunk[1] for chunk in sums) / n_boot - mean_boot**2
+    se_boot = np.sqrt(np.maximum(var_boot * n_boot / (n_boot - 1), 0))
+    
+    zmax = np.concatenate(run(se_boot), axis=0)
+    q = np.quantile(zmax, conf, axis=0)
+    q = np.repeat(q, np.diff(np.append(groupstart, len(kmdata))))
+    
+    bootdata = kmdata.copy()
+    bootdata['se_boot'] = se_boot
+    bootdata['band_ll'] = np.clip(kmestimate - q*se_boot, 0, 1)
+    bootdata['band_ul'] = np.clip(kmestimate + q*se_boot, 0, 1)
+    
+    return bootdata
+
+
+def RMSTestimate(kmdata, horizon, group=None, conf=0.95):
+    # takes a dataframe of kaplan meier estimates (from KMestimate, or KMestimategroup with its group column or list of columns)
+    # and outputs the restricted mean survival time (the area under the km curve from time 0) up to each horizon,
+    # by group, with its standard error and confidence limits
+    # horizon is a number or a list of numbers, and the result has one row per group and horizon
+    #
+    # the variance is sum over event times t up to the horizon of A(t)^2 * n_events / (atrisk * (atrisk - n_events)),
+    # with A(t) the area under the curve from t to the horizon
+    # every group and horizon is done at once, as (horizons x times) matrices
+    
+    if group is None:
+        codes = np.zeros(len(kmdata), dtype=np.int64)
+    else:
+        codes, groups = _groupcodes(kmdata, group)
+    
+    groupstart = _groupstarts(codes)
+    if np.unique(codes).size != groupstart.size:
+        raise ValueError("kmdata must have each group's rows together, as returned by KMestimategroup")
+    
+    horizon = np.atleast_1d(np.asarray(horizon, dtype=np.float64))[:, None]
+    time = kmdata['time'].to_numpy(dtype=np.float64)
+    atrisk = kmdata['atrisk'].to_numpy(dtype=np.float64)
+    n_events = kmdata['n_events'].to_numpy(dtype=np.float64)
+    kmestimate = kmdata['kmestimate'].to_numpy(dtype=np.float64)
+    
+    # the km estimate at each time holds until the group's next time (or forever after its last)
+    lengths = np.diff(np.append(groupstart, len(kmdata)))
+    groupend = groupstart + lengths - 1
+    time_next = np.append(time[1:], np.inf)
+    time_next[groupend] = np.inf
+    
+    # (horizons x times) areas under each step, and from each time to the horizon
+    area = kmestimate * np.clip(np.minimum(time_next, horizon) - np.maximum(time, 0), 0, None)
+    area_after = np.repeat(np.add.reduceat(area, groupstart, axis=-1), lengths, axis=-1) - _cumsumby(area, groupstart) + area
+    
+    # survival is 1 from time 0 to each group's first time
+    first = np.clip(np.minimum(time[groupstart], horizon), 0, None)
+    rmst = first + np.add.reduceat(area, groupstart, axis=-1)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = np.where(
+            (time <= horizon) & (n_events > 0) & (atrisk > n_events), 
+            area_after**2 * n_events / (atrisk * (atrisk - n_events)), 
+            0
+        )
+    se_rmst = np.sqrt(np.add.reduceat(terms, groupstart, axis=-1))
+    
+    z = NormalDist().inv_cdf((1 + conf) / 2)
+    
+    rmstdata = pd.DataFrame({
+        'horizon': np.repeat(horizon[:, 0], groupstart.size),
+        'rmst': rmst.ravel(),
+        'se_rmst': se_rmst.ravel(),
+        'rmst_ll': (rmst - z*se_rmst).ravel(),
+        'rmst_ul': (rmst + z*se_rmst).ravel(),
+    })
+    if group is not None:
+        groupcolumns = _groupcolumns(group, groups, np.tile(codes[groupstart], horizon.shape[0]))
+        for k, (col, values) in enumerate(groupcolumns.items()):
+            rmstdata.insert(k, col, values)
+    
+    return rmstdata
+
+
+def RMSTdiff(rmstdata, group, conf=0.95):
+    # takes restricted mean survival times by group (from RMSTestimate)
+    # and outputs the difference (group_1 - group_2) for every pair of groups at each horizon,
+    # with its standard error, confidence limits, and two-sided p-value, treating groups as independent
+    
+    rmstdata = rmstdata.reset_index(drop=True)
+    horizoncodes = pd.factorize(rmstdata['horizon'])[0]
+    
+    # every pair of rows within the same horizon, in the order the groups appear
+    row1, row2 = np.triu_indices(len(rmstdata), k=1)
+    samehorizon = horizoncodes[row1] == horizoncodes[row2]
+    row1 = row1[samehorizon]
+    row2 = row2[samehorizon]
+    
+    rmst = rmstdata['rmst'].to_numpy()
+    se_rmst = rmstdata['se_rmst'].to_numpy()
+    diff = rmst[row1] - rmst[row2]
+    se_diff = np.sqrt(se_rmst[row1]**2 + se_rmst[row2]**2)
+    
+    normal = NormalDist()
+    z = normal.inv_cdf((1 + conf) / 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zstat = np.abs(diff / se_diff)
+    
+    return pd.DataFrame({
+        group + '_1': rmstdata[group].to_numpy()[row1],
+        group + '_2': rmstdata[group].to_numpy()[row2],
+        'horizon': rmstdata['horizon'].to_numpy()[row1],
+        'rmst_diff': diff,
+        'se_rmst_diff': se_diff,
+        'rmst_diff_ll': diff - z*se_diff,
+        'rmst_diff_ul': diff + z*se_diff,
+        'pvalue': [2 * normal.cdf(-x) if np.isfinite(x) else np.nan for x in zstat],
+    })
+
+
+def logrank(kmdata, group, strata=None):
+    # takes a dataframe of kaplan meier estimates by group (from KMestimategroup)
+    # and outputs the log-rank test comparing every pair of groups,
+    # stratified by strata (a column) if given, eg from KMestimategroup(df, time, indicator, [strata, group])
+    #
+    # observed and expected events are for group_1, summed over the times (and strata) where the two groups are compared
+    # each group's atrisk and n_events are put on one grid of (strata x groups x times), 
+    # where atrisk between a group's own times is its atrisk at its next time (0 after its last),
+    # and all pairs are computed at once from (strata x pairs x times) matrices
+    
+    groupcodes, groups = pd.factorize(kmdata[group])
+    if strata is None:
+        stratacodes = np.zeros(len(kmdata), dtype=np.int64)
+    else:
+        stratacodes = pd.factorize(kmdata[strata])[0]
+    
+    unq_times, timecodes = np.unique(kmdata['time'].to_numpy(), return_inverse=True)
+    nstrata = stratacodes.max() + 1 if len(kmdata) > 0 else 1
+    shape = (nstrata, len(groups), unq_times.size)
+    cell = np.ravel_multi_index((stratacodes, groupcodes, timecodes), shape)
+    
+    n_events = np.zeros(shape).ravel()
+    n_events[cell] = kmdata['n_events'].to_numpy()
+    n_events = n_events.reshape(shape)
+    
+    # fill atrisk backwards from each group's next time: the index of the next filled cell, via a reversed running minimum
+    atrisk = np.append(np.zeros(shape).ravel(), 0)
+    atrisk[cell] = kmdata['atrisk'].to_numpy()
+    filled = np.full(shape, atrisk.size - 1)
+    filled.ravel()[cell] = cell
+    filled = np.minimum.accumulate(filled[..., ::-1], axis=-1)[..., ::-1]
+    atrisk = atrisk[filled]
+    
+    pair1, pair2 = np.triu_indices(len(groups), k=1)
+    atrisk1 = atrisk[:, pair1, :]
+    atrisk_pair = atrisk1 + atrisk[:, pair2, :]
+    n_events_pair = n_events[:, pair1, :] + n_events[:, pair2, :]
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share1 = np.where(atrisk_pair > 0, atrisk1 / atrisk_pair, 0)
+        variance = np.where(
+            atrisk_pair > 1, 
+            n_events_pair * share1 * (1 - share1) * (atrisk_pair - n_events_pair) / (atrisk_pair - 1), 
+            0
+        ).sum(axis=(0, 2))
+    
+    observed1 = n_events[:, pair1, :].sum(axis=(0, 2))
+    expected1 = (n_events_pair * share1).sum(axis=(0, 2))
+    observed2 = n_events[:, pair2, :].sum(axis=(0, 2))
+    expected2 = n_events_pair.sum(axis=(0, 2)) - expected1
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chisq = (observed1 - expected1)**2 / variance
+    
+    normal = NormalDist()
+    
+    return pd.DataFrame({
+        group + '_1': groups.take(pair1),
+        group + '_2': groups.take(pair2),
+        'observed_1': observed1,
+        'expected_1': expected1,
+        'observed_2': observed2,
+        'expected_2': expected2,
+        'variance': variance,
+        'chisq': chisq,
+        'pvalue': [2 * normal.cdf(-np.sqrt(x)) if np.isfinite(x) else np.nan for x in chisq],
+    })
+
+
+def _CIFarrays(time, eventtype, groupcodes):
+    # aalen-johansen cumulative incidence for competing risks, for records labelled by integer group codes
+    # eventtype is 0 for censored and a positive integer code for each cause (eg 1=covid death, 2=non-covid death)
+    # returns the group code and time of each distinct (group, time), the causes,
+    # and arrays of at-risk counts, censorings, overall survival, and (times x causes) event counts and cumulative incidences
+    
+    eventtype = np.asarray(eventtype)
+    causes = np.unique(eventtype[eventtype > 0])
+    
+    unq_codes, unq_times, inverse = _distinctindex(time, groupcodes)
+    ntimes = unq_times.size
+    
+    # (times x [censored, causes...]) count matrix from one bincount
+    cause_index = np.searchsorted(causes, eventtype) + 1
+    cause_index[eventtype <= 0] = 0
+    counts = np.bincount(
+        inverse * (causes.size + 1) + cause_index, 
+        minlength=ntimes * (causes.size + 1)
+    ).reshape(ntimes, causes.size + 1)
+    
+    count = counts.sum(axis=1)
+    censored = counts[:, 0]
+    n_cause = counts[:, 1:]
+    n_events = n_cause.sum(axis=1)
+    
+    groupstart = _groupstarts(unq_codes)
+    atrisk = _atriskby(count, groupstart)
+    
+    # overall survival, and survival just before each time
+    surv = _KMsurvivalby(n_events, atrisk, groupstart)
+    surv_prev = np.concatenate(([1.0], surv[:-1]))
+    surv_prev[groupstart] = 1.0
+    
+    cmlinc = np.zeros((ntimes, causes.size))
+    for k in range(causes.size):
+        cmlinc[:, k] = _cumsumby(surv_prev * n_cause[:, k] / atrisk, groupstart)
+    
+    return unq_codes, unq_times, causes, atrisk, censored, surv, n_cause, cmlinc
+
+
+def _CIFtable(unq_times, causes, atrisk, censored, surv, n_cause, cmlinc):
+    # dataframe with one row per distinct time and n_events_<cause> and cmlinc_<cause> columns for each cause
+    
+    cifdata = pd.DataFrame({
+        'time': unq_times,
+        'atrisk': atrisk,
+        'n_events': n_cause.sum(axis=1),
+        'censored': censored,
+        'kmestimate': surv,
+    })
+    for k, cause in enumerate(causes):
+        cifdata['n_events_' + str(cause)] = n_cause[:, k]
+        cifdata['cmlinc_' + str(cause)] = cmlinc[:, k]
+    
+    return cifdata
+
+
+def CIFestimate(time, eventtype):
+    
+    ## function that takes event times (=time, a series) and an event type code (=eventtype, a series taking values 0=censor, 1,2,...=cause)
+    ## and produces aalen-johansen cumulative incidence estimates for every cause in a dataframe
+    ## kmestimate is overall (all-cause) event-free survival, so that kmestimate + sum of cmlinc_<cause> = 1
+    
+    time = np.asarray(time)
+    _, unq_times, causes, atrisk, censored, surv, n_cause, cmlinc = _CIFarrays(
+        time, eventtype, np.zeros(time.size, dtype=np.int64)
+    )
+    
+    return _CIFtable(unq_times, causes, atrisk, censored, surv, n_cause, cmlinc)
+
+
+def CIFestimategroup(df, time, eventtype, group):
+    # takes a dataframe (df) with columns (time, eventtype, group)
+    # and outputs cumulative incidence estimates as in CIFestimate, by group
+    # causes are those seen in any group, so every group has the same columns
+    
+    codes, groups = pd.factorize(df[group])
+    keep = codes >= 0
+    
+    unq_codes, unq_times, causes, atrisk, censored, surv, n_cause, cmlinc = _CIFarrays(
+        df[time].to_numpy()[keep], 
+        df[eventtype].to_numpy()[keep], 
+        codes[keep]
+    )
+    
+    cifdata = _CIFtable(unq_times, causes, atrisk, censored, surv, n_cause, cmlinc)
+    cifdata.insert(0, group, groups.take(unq_codes))
+    
+    return cifdata
+
+
+def MCFestimate(df, origindate, eventdates, censordate, group=None):
+    # takes a dataframe (df) with an origin date, a list of recurrent event date columns, and a censor date
+    # eg eventdates=['admitted_unplanned_1_date', ..., 'admitted_unplanned_6_date'] and censordate='lastfup_date'
+    # and outputs the nelson-aalen mean cumulative function (expected number of events per patient) by day since origin,
+    # with the lawless-nadeau robust standard error, optionally by group
+    # date columns can be datetimes or encoded day offsets, and the wide event columns are used as they are
+    #
+    # patients are under observation from day 0 to their censor day, and events in that window are counted
+    # the mcf increments are events / patients under observation on each day of a (groups x days) grid,
+    # and each patient's contribution to the variance is tracked through difference arrays over the same grid
+    
+    origin, origin_missing = _todays(df[origindate])
+    censor, censor_missing = _todays(df[censordate])
+    
+    if group is None:
+        codes = np.zeros(len(df), dtype=np.int64)
+        groups = None
+    else:
+        codes, groups = pd.factorize(df[group])
+    
+    keep = ~origin_missing & ~censor_missing & (censor >= origin) & (codes >= 0)
+    codes = codes[keep]
+    censor = censor[keep] - origin[keep]
+    origin = origin[keep]
+    ngroups = 1 if groups is None else len(groups)
+    
+    # (patients x events) event days since origin, sorted within each row, nan if missing or outside follow-up
+    events = np.full((codes.size, len(eventdates)), np.nan)
+    for k, col in enumerate(eventdates):
+        days, missing = _todays(df[col])
+        days = (days[keep] - origin).astype(np.float64)
+        days[missing[keep] | (days < 0) | (days > censor)] = np.nan
+        events[:, k] = days
+    events.sort(axis=1)
+    has_event = ~np.isnan(events)
+    
+    ndays = (censor.max() + 1) if codes.size > 0 else 0
+    size = ngroups * (ndays + 1)
+    
+    def gridsum(day, weights=None):
+        # (groups x days) sums of weights at each patient's (group, day), with day ndays as an overflow column
+        return np.bincount(
+            codes * (ndays + 1) + day, weights=weights, minlength=size
+        ).reshape(ngroups, ndays + 1)
+    
+    # patients under observation on each day
+    atrisk = np.cumsum(gridsum(np.zeros(codes.size, dtype=np.int64)) - gridsum(censor + 1), axis=1)[:, :ndays]
+    
+    event_codes = np.broadcast_to(codes[:, None], events.shape)[has_event]
+    event_days = events[has_event].astype(np.int64)
+    n_events = np.bincount(event_codes * (ndays + 1) + event_days, minlength=size).reshape(ngroups, ndays + 1)[:, :ndays]
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_atrisk = np.where(atrisk > 0, 1/atrisk, 0)
+    dmcf = n_events * inv_atrisk
+    mcf = np.cumsum(dmcf, axis=1)
+    
+    # robust variance: sum over patients of (sum over their days of (dN_i - dmcf) / atrisk)^2
+    # while under observation a patient's term is b_i(t) - G(t), with G = cumsum(dmcf / atrisk)
+    # and b_i(t) the sum of 1/atrisk over their events so far, so the sum over patients under observation is
+    # sum(b_i^2) - 2 G sum(b_i) + G^2 atrisk, and patients who have left contribute their final term
+    cml_g = np.cumsum(dmcf * inv_atrisk, axis=1)
+    
+    event_inv = np.zeros(events.shape)
+    event_inv[has_event] = inv_atrisk[event_codes, event_days]
+    b_after = np.cumsum(event_inv, axis=1)
+    b_before = b_after - event_inv
+    b_final = b_after[:, -1] if events.shape[1] > 0 else np.zeros(codes.size)
+    
+    # changes to sum(b_i) and sum(b_i^2) at each event, and their removal after each patient's censor day
+    sum_b = np.zeros((ngroups, ndays + 1))
+    sum_b2 = np.zeros((ngroups, ndays + 1))
+    np.add.at(sum_b, (event_codes, event_days), event_inv[has_event])
+    np.add.at(sum_b2, (event_codes, event_days), (b_after**2 - b_before**2)[has_event])
+    sum_b -= gridsum(censor + 1, b_final)
+    sum_b2 -= gridsum(censor + 1, b_final**2)
+    sum_b = np.cumsum(sum_b, axis=1)[:, :ndays]
+    sum_b2 = np.cumsum(sum_b2, axis=1)[:, :ndays]
+    
+    final_term = b_final - cml_g[codes, censor]
+    left = np.cumsum(gridsum(censor + 1, final_term**2), axis=1)[:, :ndays]
+    
+    var_mcf = sum_b2 - 2 * cml_g * sum_b + cml_g**2 * atrisk + left
+    
+    mcfdata = pd.DataFrame({
+        'time': np.tile(np.arange(ndays), ngroups),
+        'atrisk': atrisk.ravel(),
+        'n_events': n_events.ravel(),
+        'mcf': mcf.ravel(),
+        'se_mcf': np.sqrt(np.maximum(var_mcf.ravel(), 0)),
+    })
+    if groups is not None:
+        mcfdata.insert(0, group, groups.repeat(ndays))
     
-    return kmdata
\ No newline at end of file
+    return mcfdata
@@ -0,0 +1,266 @@
+import pandas as pd
+import numpy as np
+
+
+## counting-process (start, stop] data, as built by survival::tmerge in analysis/R/data_stset.R
+## times are numbers of days from the study start date (eg tte_ variables), with nan for "never"
+
+
+def _asnames(columns):
+    # takes a list of column names, or a dict of output name: column name,
+    # and returns it as a dict
+    if isinstance(columns, dict):
+        return columns
+    return {col: col for col in columns}
+
+
+def _times(df, col, default=np.nan):
+    # column of df as a float array with missing values as nan, or a scalar (eg tstart=0) broadcast to every row
+    if isinstance(col, str):
+        return df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+    return np.full(len(df), col if col is not None else default, dtype=np.float64)
+
+
+def splitintervals(tstart, tstop, cuts):
+    # takes one interval (tstart, tstop] per patient and a (patients x k) array of cut times
+    # and returns the patient index, tstart and tstop of the non-overlapping intervals
+    # made by cutting each patient's interval at every cut time strictly inside it, in (patient, tstart) order
+    # cut times outside the interval, or nan, are ignored, and patients with tstop <= tstart get no intervals
+
+    # each patient's boundaries in one row, sorted within the row so no global sort is needed
+    inside = (cuts > tstart[:, None]) & (cuts < tstop[:, None])
+    bounds = np.column_stack((tstart, np.where(inside, cuts, np.nan), tstop))
+    bounds.sort(axis=1)
+
+    # consecutive strictly increasing boundaries are the intervals; nan (sorted last) and ties drop out
+    lower = bounds[:, :-1]
+    upper = bounds[:, 1:]
+    valid = upper > lower
+
+    patient = np.broadcast_to(np.arange(len(tstart))[:, None], lower.shape)[valid]
+
+    return patient, lower[valid], upper[valid]
+
+
+def tmergechunk(df, id, tstart, tstop, tdcs=(), events=(), keep=None):
+    # takes a one-row-per-patient dataframe (df) and outputs counting-process data for those patients,
+    # equivalent to survival::tmerge with tdc() and event() terms:
+    # non-overlapping (tstart, tstop] intervals split at every tdc and event time,
+    # with each tdc column 1 from its time onwards (0 before, or if missing)
+    # and each event column 1 on the interval ending at its time
+    # every column of df is repeated on each of the patient's intervals, as in tmerge,
+    # unless keep is given as the list of columns to carry (the id column is always kept)
+    #
+    # tstart and tstop are column names or numbers (eg tstart=0)
+    # tdcs and events are lists of time columns, or dicts of output name: time column
+    # eg tdcs={'vaxany1_status': 'tte_vaxany1', 'vaxany2_status': 'tte_vaxany2'}, events={'postest': 'tte_postest'}
+
+    tdcs = _asnames(tdcs)
+    events = _asnames(events)
+
+    start = _times(df, tstart)
+    stop = _times(df, tstop)
+    cuts = np.column_stack(
+        [_times(df, col) for col in list(tdcs.values()) + list(events.values())]
+    ) if (tdcs or events) else np.zeros((len(df), 0))
+
+    patient, lower, upper = splitintervals(start, stop, cuts)
+
+    # patient columns, except any replaced by the new tstart, tstop, tdc and event columns
+    keep = [col for col in (df.columns if keep is None else keep) if col != id]
+    keep = [id] + [col for col in keep if col not in {'tstart', 'tstop', *tdcs, *events}]
+    cpdata = df[keep].iloc[patient].reset_index(drop=True)
+    cpdata['tstart'] = lower
+    cpdata['tstop'] = upper
+
+    # tdc and event values on each interval, from the patient's cut times
+    for k, name in enumerate(tdcs):
+        cpdata[name] = (cuts[patient, k] <= lower).astype(np.int8)
+    for k, name in enumerate(events, start=len(tdcs)):
+        cpdata[name] = (cuts[patient, k] == upper).astype(np.int8)
+
+    # keep integer times as integers, unless a cut time (eg a tdc at 2.5) has made a boundary that is not a whole number
+    # (tmerge then concatenates any such chunk with the integer chunks as float64)
+    if (
+        all(pd.api.types.is_integer_dtype(df[col]) for col in (tstart, tstop) if isinstance(col, str))
+        and np.array_equal(lower, np.floor(lower)) and np.array_equal(upper, np.floor(upper))
+    ):
+        cpdata[['tstart', 'tstop']] = cpdata[['tstart', 'tstop']].astype(np.int32)
+
+    return cpdata
+
+
+def tmergechunks(df, id, tstart, tstop, tdcs=(), events=(), keep=None, chunksize=100000):
+    # as tmergechunk, yielding the counting-process data for chunksize patients at a time
+    # so that the full counting-process dataset never needs to be held in memory
+    # patients are taken in the order of df, so sort df by id first if chunks should be in id order
+
+    for first in range(0, len(df), chunksize):
+        yield tmergechunk(df.iloc[first:first+chunksize], id, tstart, tstop, tdcs, events, keep)
+
+
+def tmerge(df, id, tstart, tstop, tdcs=(), events=(), keep=None, chunksize=100000):
+    # counting-process data for every patient in df, as in tmergechunk
+    # built chunksize patients at a time to bound the size of the intermediate arrays
+
+    chunks = list(tmergechunks(df, id, tstart, tstop, tdcs, events, keep, chunksize))
+    if not chunks:
+        return tmergechunk(df, id, tstart, tstop, tdcs, events, keep)
+
+    return pd.concat(chunks, ignore_index=True)
+
+
+def persontime(cpdata, tstart, tstop, strata=(), events=(), origin=None):
+    # takes counting-process data (cpdata), eg from tmerge, with (tstart, tstop] intervals in whole days
+    # and outputs person-days at risk and event counts for each stratum and day,
+    # without expanding to one row per patient per day
+    #
+    # strata are columns constant within each interval (eg vaxany1_status, sex)
+    # events are 0/1 columns for events at tstop
+    # day d covers (d-1, d], so an event at tstop is counted on day tstop
+    # if origin is given (a column or number), days are counted from it instead (eg origin='tte_vaxany1' for days since vaccination)
+    #
+    # each interval adds +1 at its start and -1 at its end in a (strata x days) difference array,
+    # and a cumulative sum along days gives the number at risk on each day
+
+    strata = list(strata)
+    events = list(events)
+
+    start = _times(cpdata, tstart)
+    stop = _times(cpdata, tstop)
+    if origin is not None:
+        offset = _times(cpdata, origin)
+        start = start - offset
+        stop = stop - offset
+
+    # intervals with no time on the chosen axis (eg before vaccination, when origin is missing) are left out
+    keep = np.isfinite(start) & np.isfinite(stop) & (stop > start)
+    start = start[keep].astype(np.int64)
+    stop = stop[keep].astype(np.int64)
+
+    if strata:
+        grouped = cpdata[keep].groupby(strata, sort=True, observed=True, dropna=False)
+        codes = grouped.ngroup().to_numpy()
+        levels = grouped.size().index
+        nstrata = len(levels)
+    else:
+        codes = np.zeros(start.size, dtype=np.int64)
+        nstrata = 1
+
+    daymin = start.min() if start.size > 0 else 0
+    ndays = (stop.max() - daymin) if start.size > 0 else 0
+
+    diff = (
+        np.bincount(codes * (ndays + 1) + (start - daymin), minlength=nstrata * (ndays + 1))
+        - np.bincount(codes * (ndays + 1) + (stop - daymin), minlength=nstrata * (ndays + 1))
+    ).reshape(nstrata, ndays + 1)
+    persondays = np.cumsum(diff, axis=1)[:, :ndays]
+
+    ptdata = {}
+    if strata:
+        for j, col in enumerate(strata):
+            values = levels.get_level_values(j) if isinstance(levels, pd.MultiIndex) else levels
+            ptdata[col] = values.repeat(ndays)
+    ptdata['day'] = np.tile(np.arange(daymin + 1, daymin + ndays + 1), nstrata)
+    ptdata['persondays'] = persondays.ravel()
+
+    for col in events:
+        eventdays = codes * ndays + (stop - daymin - 1)
+        ptdata[col] = np.bincount(
+            eventdays, weights=cpdata[col].to_numpy()[keep], minlength=nstrata * ndays
+        ).astype(np.int64)
+
+    return pd.DataFrame(ptdata)
+
+
+## time since vaccination periods, as postvax_cut, timesince_cut and timesince2_cut in lib/utility_functions.R
+## periods are delimited by breaks, eg breaks=[0, 3, 7, 14] gives pre, 1-3, 4-7, 8-14 and 15+,
+## and are open on the left and closed on the right, so the day of vaccination itself is "pre"
+
+
+def timesincelabels(breaks, prelabel="pre", prefix=""):
+    # period labels for breaks, as in timesince_cut
+    breaks = list(breaks)
+    labels = [
+        f"{prefix}{left + 1}-{right}" for left, right in zip(breaks[:-1], breaks[1:])
+    ] + [f"{prefix}{breaks[-1] + 1}+"]
+    return [prefix + prelabel] + labels
+
+
+def timesincecut(time_since, breaks, prelabel="pre", prefix=""):
+    # vectorised timesince_cut: assigns the period containing each time since vaccination
+    # missing times (eg never vaccinated) are treated as infinite, as in timesince_cut
+    
+    time_since = np.asarray(time_since, dtype=np.float64)
+    time_since = np.where(np.isnan(time_since), np.inf, time_since)
+    codes = np.searchsorted(np.asarray(breaks, dtype=np.float64), time_since, side='left')
+    
+    return pd.Categorical.from_codes(codes, timesincelabels(breaks, prelabel, prefix))
+
+
+def periodsplit(cpdata, tstart, tstop, exposures, breaks, events=(), prelabel="pre", prefixes=None, name="period", chunksize=None):
+    # takes counting-process data (cpdata), eg from tmerge, and splits each (tstart, tstop] interval
+    # wherever the time since any of the exposure times crosses a break,
+    # adding a categorical period column (=name) that is constant within each new interval
+    #
+    # exposures is a list of exposure time columns, eg ['tte_vaxany1', 'tte_vaxany2']
+    # and the period is that of the latest exposure more than breaks[0] days before, labelled with its prefix,
+    # or prelabel if there is none, as in timesince2_cut
+    # prefixes default to "" for one exposure and "Dose 1 ", "Dose 2 ", ... for more
+    # events are 0/1 columns for events at tstop, which are kept only on the last piece of each split interval
+    #
+    # to tabulate person-time and events by period instead of keeping the split intervals,
+    # pass the result to persontime with strata=[name]
+    # rows are independent, so with chunksize the split is built chunksize rows at a time (see periodsplitchunks)
+    # to bound the size of the (rows x exposures x breaks) array of cut times
+    
+    if chunksize is not None:
+        chunks = list(periodsplitchunks(cpdata, tstart, tstop, exposures, breaks, events, prelabel, prefixes, name, chunksize))
+        if chunks:
+            return pd.concat(chunks, ignore_index=True)
+    
+    exposures = list(exposures)
+    breaks = np.asarray(breaks, dtype=np.float64)
+    if prefixes is None:
+        prefixes = [""] if len(exposures) == 1 else [f"Dose {k+1} " for k in range(len(exposures))]
+    
+    start = _times(cpdata, tstart)
+    stop = _times(cpdata, tstop)
+    exposure_times = np.column_stack([_times(cpdata, col) for col in exposures])
+    
+    # every exposure time plus every break is a potential cut
+    cuts = (exposure_times[:, :, None] + breaks[None, None, :]).reshape(len(cpdata), len(exposures) * breaks.size)
+    row, lower, upper = splitintervals(start, stop, cuts)
+    
+    split = cpdata.iloc[row].reset_index(drop=True)
+    split[tstart] = lower.astype(split[tstart].dtype) if isinstance(tstart, str) else lower
+    split[tstop] = upper.astype(split[tstop].dtype) if isinstance(tstop, str) else upper
+    
+    last = upper == stop[row]
+    for col in events:
+        split[col] = np.where(last, split[col].to_numpy(), 0).astype(split[col].dtype)
+    
+    # the period is fixed within each new interval, so is evaluated at its end
+    time_since = upper[:, None] - exposure_times[row]
+    active = time_since > breaks[0]
+    latest = len(exposures) - 1 - np.argmax(active[:, ::-1], axis=1)
+    time_since_latest = time_since[np.arange(row.size), latest]
+    
+    period_codes = np.searchsorted(breaks, time_since_latest, side='left') - 1
+    codes = np.where(active.any(axis=1), 1 + latest * breaks.size + period_codes, 0)
+    
+    labels = [prefixes[0] + prelabel] if len(exposures) == 1 else [prelabel]
+    for prefix in prefixes:
+        labels += timesincelabels(breaks.astype(int).tolist(), prelabel, prefix)[1:]
+    split[name] = pd.Categorical.from_codes(codes, labels)
+    
+    return split
+
+
+def periodsplitchunks(cpdata, tstart, tstop, exposures, breaks, events=(), prelabel="pre", prefixes=None, name="period", chunksize=100000):
+    # as periodsplit, yielding the split intervals of chunksize rows of cpdata at a time
+    # so that the full split dataset never needs to be held in memory (eg each chunk passed to persontime and the counts summed)
+    # every chunk has the same period categories, so chunks can be concatenated without losing the categorical
+    
+    for first in range(0, len(cpdata), chunksize):
+        yield periodsplit(cpdata.iloc[first:first+chunksize], tstart, tstop, exposures, breaks, events, prelabel, prefixes, name)